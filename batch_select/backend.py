@@ -0,0 +1,72 @@
+'''
+Database backend specific bits of SQL used by the batch queries.
+'''
+from django.db.models import AutoField, IntegerField
+from django.utils import simplejson
+
+_json_each_support = {}
+
+def _vendor(connection):
+    vendor = getattr(connection, 'vendor', None)
+    if vendor is None: # Django 1.2 and less
+        vendor = connection.__class__.__module__.split('.')[-2]
+    return vendor
+
+def _supports_json_each(connection):
+    # json_each is only there if sqlite was built with JSON1
+    # (which is the default from 3.38 onwards)
+    supported = _json_each_support.get(getattr(connection, 'alias', None))
+    if supported is None:
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SELECT value FROM json_each('[]')")
+            supported = True
+        except Exception:
+            supported = False
+        _json_each_support[getattr(connection, 'alias', None)] = supported
+    return supported
+
+def supports_array_param(connection):
+    vendor = _vendor(connection)
+    return vendor.startswith('postgresql') or \
+           (vendor.startswith('sqlite') and _supports_json_each(connection))
+
+def array_param_where(connection, column, ids):
+    '''
+    returns a (where, param) pair that tests column against all of the ids
+    using a single parameter, or None if the backend doesn't support that
+    
+    this keeps the sql the same no matter how many ids there are
+    '''
+    if not supports_array_param(connection):
+        return None
+    if _vendor(connection).startswith('postgresql'):
+        return '%s = ANY(%%s)' % column, list(ids)
+    return ('%s IN (SELECT value FROM json_each(%%s))' % column,
+            simplejson.dumps(list(ids)))
+
+def id_column_type(connection, model):
+    '''
+    the column type to use for storing pks of model (in the same way
+    as a ForeignKey to model would)
+    '''
+    pk = model._meta.pk
+    if isinstance(pk, AutoField):
+        return IntegerField().db_type(connection=connection)
+    return pk.db_type(connection=connection)
+
+def supports_temp_table(connection):
+    '''
+    can the batch queries use a temporary table of ids (without it
+    getting in the way of any transaction that is open)?
+    '''
+    vendor = _vendor(connection)
+    return vendor.startswith('postgresql') or vendor.startswith('sqlite') or \
+           vendor == 'mysql'
+
+def drop_temp_table_sql(connection, table):
+    if _vendor(connection) == 'mysql':
+        # a plain DROP TABLE commits the transaction, even for a
+        # temporary table
+        return 'DROP TEMPORARY TABLE %s' % table
+    return 'DROP TABLE %s' % table
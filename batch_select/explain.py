@@ -0,0 +1,72 @@
+'''
+Capture the query plans of batch queries, so that missing (or unused)
+indexes on the column used to group the related objects can be found.
+'''
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+
+from backend import _vendor
+
+import logging
+
+logger = logging.getLogger('batch_select')
+
+def _is_seq_scan(vendor, columns, plan, db_table):
+    '''
+    does the plan (a list of rows, with the given column names) show a
+    sequential scan of db_table?
+    '''
+    if vendor.startswith('sqlite'):
+        # e.g. "SCAN TABLE batch_select_entry" or "SCAN batch_select_entry"
+        for row in plan:
+            words = row[-1].split()
+            if words and words[0] == 'SCAN' and 'INDEX' not in words:
+                if db_table in words:
+                    return True
+    elif vendor.startswith('postgresql'):
+        for row in plan:
+            if 'Seq Scan on %s ' % db_table in '%s ' % row[0]:
+                return True
+    elif vendor == 'mysql':
+        table, access_type = columns.index('table'), columns.index('type')
+        for row in plan:
+            if row[table] == db_table and row[access_type] == 'ALL':
+                return True
+    return False
+
+def explain_query(queryset, db_table, id_column, parents):
+    '''
+    returns a dict describing the plan for the batch queryset, which
+    selects the related objects of parents (a count) by filtering on
+    id_column of db_table
+    '''
+    report = { 'table': db_table,
+               'column': id_column,
+               'parents': parents,
+               'sql': None,
+               'plan': [],
+               'seq_scan': False }
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        # nothing to select, so no query gets run
+        return report
+
+    connection = connections[queryset.db]
+    vendor = _vendor(connection)
+    if vendor.startswith('sqlite'):
+        explain = 'EXPLAIN QUERY PLAN '
+    else:
+        explain = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(explain + sql, params)
+    columns = [column[0] for column in cursor.description]
+    plan = list(cursor.fetchall())
+
+    report['sql'] = sql
+    report['plan'] = plan
+    report['seq_scan'] = _is_seq_scan(vendor, columns, plan, db_table)
+    if report['seq_scan']:
+        logger.warning('batch query for %d parents does a sequential scan '
+                       'of %s, is %s indexed?', parents, db_table, id_column)
+    return report
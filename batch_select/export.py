@@ -0,0 +1,171 @@
+'''
+Export a batch selected queryset (e.g. to JSON lines or CSV), splitting
+it up into ranges of pks that can be exported in parallel by a pool of
+processes, each with its own database connection.
+'''
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import get_model
+from django.utils import simplejson
+
+from models import BatchQuerySet, _related_field_info
+from serialize import _nested_batches
+
+import csv
+import itertools
+from collections import deque
+from cStringIO import StringIO
+
+FORMATS = ('jsonl', 'csv')
+
+def _reset_connections():
+    # a forked process must not use (or close) the connections it
+    # inherited, so just forget them and let new ones be made
+    for connection in connections.all():
+        connection.connection = None
+
+def _partitions(queryset, partition_size):
+    '''
+    generates (lower, upper) pk ranges - lower exclusive and upper
+    inclusive, with None for no limit - that each contain at most
+    partition_size of the objects in queryset
+    '''
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    lower = None
+    for i, pk in enumerate(pks.iterator()):
+        if i % partition_size == partition_size - 1:
+            yield lower, pk
+            lower = pk
+    yield lower, None
+
+def _check_batches(model, batches):
+    '''
+    raises ValueError for batches (or nested batches) through a path,
+    as they are attached to other objects which aren't exported
+    '''
+    for batch in batches:
+        if '__' in batch.m2m_fieldname:
+            raise ValueError('can not export "%s", batches through a '
+                             'ForeignKey are not exported' % batch.m2m_fieldname)
+        related_model = _related_field_info(model, batch.m2m_fieldname)[0]
+        nested = [nested_batch for nested_batch
+                  in _nested_batches(related_model, batch)
+                  if nested_batch is not batch] # recursive batches
+        _check_batches(related_model, nested)
+
+def _instance_values(model, instance, batches):
+    values = dict((field.attname, getattr(instance, field.attname))
+                  for field in model._meta.fields)
+    for batch in batches:
+        related = getattr(instance, batch.target_field_name, None)
+        if related is not None:
+            related_model = _related_field_info(model, batch.m2m_fieldname)[0]
+            nested = _nested_batches(related_model, batch)
+            values[batch.target_field_name] = \
+                [_instance_values(related_model, related_instance, nested)
+                 for related_instance in related]
+    return values
+
+def _csv_columns(model, batches):
+    return [field.attname for field in model._meta.fields] + \
+           [batch.target_field_name for batch in batches]
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def _write_csv(model, instances, batches, out):
+    writer = csv.writer(out)
+    attnames = [field.attname for field in model._meta.fields]
+    for instance in instances:
+        row = [_csv_value(getattr(instance, attname)) for attname in attnames]
+        # batch selected fields are written as a json list of pks
+        for batch in batches:
+            related = getattr(instance, batch.target_field_name, None) or []
+            row.append(simplejson.dumps([related_instance.pk
+                                         for related_instance in related],
+                                        cls=DjangoJSONEncoder))
+        writer.writerow(row)
+
+def _write_jsonl(model, instances, batches, out):
+    for instance in instances:
+        out.write(simplejson.dumps(_instance_values(model, instance, batches),
+                                   cls=DjangoJSONEncoder, sort_keys=True))
+        out.write('\n')
+
+def _export_partition(task):
+    app_label, object_name, query, using, batches, lower, upper, format = task
+    model = get_model(app_label, object_name)
+    queryset = BatchQuerySet(model, query=query.clone(), using=using)
+    if batches:
+        queryset = queryset.batch_select(*batches)
+    if lower is not None:
+        queryset = queryset.filter(pk__gt=lower)
+    if upper is not None:
+        queryset = queryset.filter(pk__lte=upper)
+    out = StringIO()
+    if format == 'csv':
+        _write_csv(model, queryset.order_by('pk'), batches, out)
+    else:
+        _write_jsonl(model, queryset.order_by('pk'), batches, out)
+    return out.getvalue()
+
+def export(queryset, out, format='jsonl', processes=1, partition_size=1000):
+    '''
+    write the objects in queryset, along with their batch selected
+    fields, to the file-like object out in pk order
+    
+    format is "jsonl" (one json object per line, with batch selected
+    fields as lists of objects) or "csv" (with a header row, and batch
+    selected fields as json lists of pks)
+    
+    the queryset is split into ranges of partition_size pks, which are
+    each selected (and batch selected) separately. With processes > 1
+    they are run by a multiprocessing pool, but still written in order,
+    with at most processes * 2 partitions in progress at a time.
+    
+    batches through a ForeignKey (e.g. "section__entry") can't be
+    exported, and raise a ValueError
+    '''
+    if format not in FORMATS:
+        raise ValueError('unknown export format "%s", expected one of %s' %
+                         (format, ', '.join(FORMATS)))
+    model = queryset.model
+    opts = model._meta
+    batches = list(getattr(queryset, '_batches', ()))
+    _check_batches(model, batches)
+    
+    if format == 'csv':
+        csv.writer(out).writerow(_csv_columns(model, batches))
+    
+    tasks = ((opts.app_label, opts.object_name, queryset.query, queryset.db,
+              batches, lower, upper, format)
+             for lower, upper in _partitions(queryset, partition_size))
+    
+    if processes == 1:
+        for chunk in itertools.imap(_export_partition, tasks):
+            out.write(chunk)
+        return
+    
+    from multiprocessing import Pool
+    pool = Pool(processes, initializer=_reset_connections)
+    # only let the workers get a few partitions ahead of what has been
+    # written, so that finished partitions don't pile up in memory
+    window = processes * 2
+    pending = deque()
+    try:
+        for task in tasks:
+            pending.append(pool.apply_async(_export_partition, (task,)))
+            if len(pending) >= window:
+                out.write(pending.popleft().get())
+        while pending:
+            out.write(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+
+from batch_select.export import export, FORMATS, _check_batches
+
+from optparse import make_option
+import sys
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', action='append', dest='batches', default=[],
+                    help='Field to batch select (can be given more than once).'),
+        make_option('--format', dest='format', default='jsonl',
+                    help='Output format (%s).' % ', '.join(FORMATS)),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help='Number of processes to export with.'),
+        make_option('--partition-size', dest='partition_size', type='int',
+                    default=1000,
+                    help='Number of objects each process exports at a time.'),
+        make_option('--output', '-o', dest='output', default=None,
+                    help='File to write to (defaults to stdout).'),
+    )
+    help = 'Exports the objects of a model along with batch selected fields.'
+    args = '<app_label.ModelName>'
+    
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Expected a single app_label.ModelName')
+        try:
+            app_label, model_name = args[0].split('.')
+        except ValueError:
+            raise CommandError('Expected a model in the form app_label.ModelName')
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+        if options['format'] not in FORMATS:
+            raise CommandError('Unknown format "%s", expected one of %s' %
+                               (options['format'], ', '.join(FORMATS)))
+        
+        queryset = model._default_manager.all()
+        if options['batches']:
+            if not hasattr(queryset, 'batch_select'):
+                raise CommandError('%s does not use a BatchManager' % args[0])
+            try:
+                queryset = queryset.batch_select(*options['batches'])
+                _check_batches(model, queryset._batches)
+            except (FieldDoesNotExist, ValueError), e:
+                raise CommandError(str(e))
+        
+        out = getattr(self, 'stdout', sys.stdout)
+        if options['output']:
+            out = open(options['output'], 'wb')
+        try:
+            export(queryset, out, format=options['format'],
+                   processes=options['processes'],
+                   partition_size=options['partition_size'])
+        finally:
+            if options['output']:
+                out.close()
@@ -1,10 +1,19 @@
 from django.db.models.query import QuerySet
-from django.db import models, connection
+from django.db import models, connections, router, transaction
 from django.db.models.fields import FieldDoesNotExist
 
 from django.conf import settings
 
 from replay import Replay
+from explain import explain_query
+from backend import array_param_where, id_column_type, drop_temp_table_sql
+from planner import plan_batch, plan_recursive, record_fanout, MAX_IN_LIST
+
+import itertools
+import logging
+import weakref
+
+logger = logging.getLogger('batch_select')
 
 def _not_exists(fieldname):
     raise FieldDoesNotExist('"%s" is not a ManyToManyField or a reverse ForeignKey relationship' % fieldname)
@@ -24,6 +33,40 @@ def _check_field_exists(model, fieldname):
             _not_exists(fieldname)
     return fieldname
 
+def _resolve_path(model, fieldname):
+    '''
+    splits a fieldname like "section__entry" into the path of forward
+    foreign keys to follow (['section']), the model at the end of the
+    path (Section) and the field to batch select on that model ("entry")
+    '''
+    path = fieldname.split('__')
+    fieldname = path.pop()
+    for name in path:
+        field = model._meta.get_field(name)
+        if not isinstance(field, models.ForeignKey):
+            raise FieldDoesNotExist('"%s" is not a ForeignKey' % name)
+        model = field.rel.to
+    _check_field_exists(model, fieldname)
+    return path, model, fieldname
+
+def _follow_path(instances, path):
+    '''
+    returns the distinct instances (by pk) at the end of path from
+    instances, and a list of (duplicate, instance) pairs for the others
+    '''
+    for name in path:
+        instances = [getattr(instance, name) for instance in instances]
+        instances = [instance for instance in instances if instance is not None]
+    distinct, duplicates, by_id = [], [], {}
+    for instance in instances:
+        first = by_id.get(instance.pk)
+        if first is None:
+            by_id[instance.pk] = instance
+            distinct.append(instance)
+        elif first is not instance:
+            duplicates.append((instance, first))
+    return distinct, duplicates
+
 def _id_attr(id_column):
     # mangle the id column name, so we can make sure
     # the postgres doesn't complain about not quoting
@@ -31,16 +74,180 @@ def _id_attr(id_column):
     # with the regular id column)
     return '__%s' % id_column.lower()
 
-def _select_related_instances(related_model, related_name, ids, db_table, id_column):
-    id__in_filter={ ('%s__pk__in' % related_name): ids }
-    qn = connection.ops.quote_name
+def _related_field_info(model, fieldname):
+    '''
+    returns (related_model, related_name, id_column, db_table) for
+    the many-to-many or reverse foreign key field on model
+    '''
+    fieldname = _check_field_exists(model, fieldname)
+    field_object, model, direct, m2m = model._meta.get_field_by_name(fieldname)
+    if m2m:
+        if not direct:
+            m2m_field = field_object.field
+            related_model = field_object.model
+            related_name = m2m_field.name
+            id_column = m2m_field.m2m_reverse_name()
+            db_table = m2m_field.m2m_db_table()
+        else:
+            m2m_field = field_object
+            related_model = m2m_field.rel.to # model on other end of relationship
+            related_name = m2m_field.related_query_name()
+            id_column = m2m_field.m2m_column_name()
+            db_table  = m2m_field.m2m_db_table()
+    elif not direct:
+        # handle reverse foreign key relationships
+        fk_field = field_object.field
+        related_model = field_object.model
+        related_name  = fk_field.name
+        id_column = fk_field.column
+        db_table = related_model._meta.db_table
+    return related_model, related_name, id_column, db_table
+
+def _select_related_instances_where(related_model, related_name, db_table,
+                                    id_column, where, params, using):
+    qn = connections[using].ops.quote_name
     select = { _id_attr(id_column): '%s.%s' % (qn(db_table), qn(id_column)) }
+    # still filter on the relationship, so that any join is made
+    not_null_filter = { ('%s__pk__isnull' % related_name): False }
+    return related_model._default_manager \
+                .using(using) \
+                .filter(**not_null_filter) \
+                .extra(select=select, where=[where], params=params)
+
+def _select_related_instances(related_model, related_name, ids, db_table, id_column,
+                              array_param=False, using=None):
+    if using is None:
+        using = router.db_for_read(related_model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    column = '%s.%s' % (qn(db_table), qn(id_column))
+    select = { _id_attr(id_column): column }
+    array_where = None
+    if array_param and ids:
+        array_where = array_param_where(connection, column, ids)
+    if array_where is not None:
+        where, param = array_where
+        return _select_related_instances_where(related_model, related_name,
+                                               db_table, id_column,
+                                               where, [param], using)
+    id__in_filter={ ('%s__pk__in' % related_name): ids }
     related_instances = related_model._default_manager \
+                            .using(using) \
                             .filter(**id__in_filter) \
                             .extra(select=select)
     return related_instances
 
-def batch_select(model, instances, target_field_name, fieldname, filter=None):
+_temp_table_ids = itertools.count(1)
+
+def _planned_related_instances(plan, model, related_model, related_name, ids,
+                               db_table, id_column, parent_query, using):
+    '''
+    generates the queryset(s) for selecting the related instances from
+    the database using, in the way given by plan (see planner.plan_batch)
+    '''
+    strategy = plan['strategy']
+    if strategy == 'chunked':
+        chunk_size = plan.get('chunk_size', MAX_IN_LIST)
+        for start in xrange(0, len(ids), chunk_size):
+            yield _select_related_instances(related_model, related_name,
+                                            ids[start:start + chunk_size],
+                                            db_table, id_column, using=using)
+    elif strategy == 'subquery':
+        yield _select_related_instances(related_model, related_name,
+                                        parent_query.values('pk'),
+                                        db_table, id_column, using=using)
+    elif strategy == 'temp_table' and ids:
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        temp_table = qn('batch_select_ids_%d' % _temp_table_ids.next())
+        cursor = connection.cursor()
+        cursor.execute('CREATE TEMPORARY TABLE %s (id %s)' % 
+                       (temp_table, id_column_type(connection, model)))
+        try:
+            cursor.executemany('INSERT INTO %s (id) VALUES (%%s)' % temp_table,
+                               [(id,) for id in ids])
+            where = '%s.%s IN (SELECT id FROM %s)' % (qn(db_table),
+                                                      qn(id_column), temp_table)
+            yield _select_related_instances_where(related_model, related_name,
+                                                  db_table, id_column,
+                                                  where, [], using)
+        finally:
+            cursor.execute(drop_temp_table_sql(connection, temp_table))
+    else:
+        yield _select_related_instances(related_model, related_name,
+                                        ids, db_table, id_column,
+                                        strategy == 'array', using)
+
+def _group_by_db(instances, related_model, using=None):
+    '''
+    returns a list of (alias, instances) pairs, grouping instances by the
+    database their related_model instances should be read from - using
+    if given, otherwise as decided by the routers (which default to
+    the database each instance came from)
+    '''
+    if using is not None:
+        return [(using, instances)]
+    if not instances:
+        # still go through the (empty) query, so it can be explained
+        return [(router.db_for_read(related_model), instances)]
+    groups, aliases = {}, []
+    for instance in instances:
+        alias = router.db_for_read(related_model, instance=instance)
+        if alias not in groups:
+            groups[alias] = []
+            aliases.append(alias)
+        groups[alias].append(instance)
+    return [(alias, groups[alias]) for alias in aliases]
+
+def _order_by_id_attr(related_instances, id_attr):
+    # put the grouping column first, keeping any ordering that
+    # has already been asked for as a secondary ordering
+    query = related_instances.query
+    if query.extra_order_by:
+        ordering = query.extra_order_by
+    elif not query.default_ordering:
+        ordering = query.order_by
+    else:
+        ordering = query.order_by or related_instances.model._meta.ordering
+    return related_instances.extra(order_by=[id_attr] + list(ordering))
+
+def _group_related_instances(related_instances, id_attr, grouped=None):
+    if grouped is None:
+        grouped = {}
+    for related_instance in related_instances:
+        instance_id = getattr(related_instance, id_attr)
+        group = grouped.get(instance_id, [])
+        group.append(related_instance)
+        grouped[instance_id] = group
+    return grouped
+
+def _merge_related_instances(by_id, target_field_name,
+                             related_instances, id_attr):
+    # related instances arrive ordered by the grouping column, so each
+    # group is complete as soon as the column value changes
+    # (returns the number of related instances)
+    def _attach(instance_id, group):
+        instance = by_id.get(instance_id)
+        if instance is not None:
+            setattr(instance, target_field_name, group)
+    
+    count = 0
+    current_id, group = None, None
+    for related_instance in related_instances.iterator():
+        instance_id = getattr(related_instance, id_attr)
+        if group is None or instance_id != current_id:
+            if group is not None:
+                _attach(current_id, group)
+            current_id, group = instance_id, []
+        group.append(related_instance)
+        count += 1
+    if group is not None:
+        _attach(current_id, group)
+    return count
+
+def batch_select(model, instances, target_field_name, fieldname, filter=None,
+                 merge=False, explain=None, plan=None, parent_query=None,
+                 using=None):
     '''
     basically do an extra-query to select the many-to-many
     field values into the instances given. e.g. so we can get all
@@ -56,53 +263,297 @@ def batch_select(model, instances, target_field_name, fieldname, filter=None):
     filter is a function that can be used alter the extra-query - it 
     takes a queryset and returns a filtered version of the queryset
     
+    if merge is True the extra-query is ordered by the grouping column
+    and streamed, attaching the related instances one instance at a
+    time rather than building up a dict of the whole result first
+    
+    if explain is a list, a report of the query plan used for the
+    extra-query is appended to it (see explain.explain_query)
+    
+    plan says how the extra-query should be run (see planner.plan_batch),
+    by default it uses an IN list of all the ids. parent_query is the
+    queryset the instances came from, for the 'subquery' strategy
+    
+    using is the database to run the extra-query on. By default the
+    routers decide for each instance (which normally means using the
+    database each instance came from)
+    
     NB: this is a semi-private API at the moment, but may be useful if you
     dont want to change your model/manager.
     '''
     
+    instances = list(instances)
+    
+    related_model, related_name, id_column, db_table = \
+        _related_field_info(model, fieldname)
+    
+    if plan is None:
+        plan = { 'strategy': 'in' }
+    
+    id_attr = _id_attr(id_column)
+    count = 0
+    # instances from different databases could share pks, so each
+    # database's instances are grouped separately
+    for alias, db_instances in _group_by_db(instances, related_model, using):
+        ids = [instance.pk for instance in db_instances]
+        grouped = {}
+        if plan['strategy'] == 'subquery' and parent_query.db != alias:
+            # can only use the parent query on its own database, the
+            # plan is changed so that it shows what was actually run
+            plan['strategy'] = 'chunked'
+            plan['reason'] = 'parent query is on another database'
+            plan.setdefault('chunk_size', MAX_IN_LIST)
+        if merge:
+            by_id = dict((instance.pk, instance) for instance in db_instances)
+            for instance in db_instances:
+                setattr(instance, target_field_name, [])
+        
+        for related_instances in _planned_related_instances(plan, model,
+                                                            related_model,
+                                                            related_name, ids,
+                                                            db_table, id_column,
+                                                            parent_query, alias):
+            if filter:
+                related_instances = filter(related_instances)
+            
+            if merge:
+                related_instances = _order_by_id_attr(related_instances, id_attr)
+            
+            if explain is not None:
+                report = explain_query(related_instances, db_table, id_column,
+                                       len(ids))
+                report['field'] = target_field_name
+                report['strategy'] = plan['strategy']
+                explain.append(report)
+            
+            if merge:
+                count += _merge_related_instances(by_id, target_field_name,
+                                                  related_instances, id_attr)
+            else:
+                _group_related_instances(related_instances, id_attr, grouped)
+        
+        if not merge:
+            for instance in db_instances:
+                setattr(instance, target_field_name, grouped.get(instance.pk, []))
+            count += sum(len(group) for group in grouped.values())
+    
+    record_fanout(model, fieldname, len(instances), count)
+    
+    return instances
+
+def _select_tree(related_model, fk_field, ids, max_depth, using):
+    qn = connections[using].ops.quote_name
+    tree = { 'table': qn(related_model._meta.db_table),
+             'pk': qn(related_model._meta.pk.column),
+             'fk': qn(fk_field.column),
+             'ids': ', '.join(['%s'] * len(ids)) }
+    if max_depth is None:
+        # UNION rather than UNION ALL, so this stops even if there's a cycle
+        cte = 'WITH RECURSIVE batch_tree(id) AS (' \
+              'SELECT %(pk)s FROM %(table)s WHERE %(fk)s IN (%(ids)s) ' \
+              'UNION SELECT t.%(pk)s FROM %(table)s t ' \
+              'INNER JOIN batch_tree ON t.%(fk)s = batch_tree.id' \
+              ') SELECT id FROM batch_tree' % tree
+        params = ids
+    else:
+        cte = 'WITH RECURSIVE batch_tree(id, depth) AS (' \
+              'SELECT %(pk)s, 1 FROM %(table)s WHERE %(fk)s IN (%(ids)s) ' \
+              'UNION ALL SELECT t.%(pk)s, batch_tree.depth + 1 FROM %(table)s t ' \
+              'INNER JOIN batch_tree ON t.%(fk)s = batch_tree.id ' \
+              'WHERE batch_tree.depth < %%s' \
+              ') SELECT id FROM batch_tree' % tree
+        params = ids + [max_depth]
+    where = '%s.%s IN (%s)' % (tree['table'], tree['pk'], cte)
+    return related_model._default_manager \
+                .using(using) \
+                .extra(where=[where], params=params)
+
+def batch_select_recursive(model, instances, target_field_name, fieldname,
+                           filter=None, max_depth=None, using=None,
+                           explain=None):
+    '''
+    like batch_select, but for a self-referential reverse foreign key
+    (e.g. the children of a category), selecting the whole tree below
+    the instances given in one query using WITH RECURSIVE
+    
+    every instance in the tree, down to max_depth levels below the
+    instances given (or all the way down if max_depth is None), has
+    its related instances attached as target_field_name
+    
+    filter is applied to the extra-query, so affects every level
+    
+    using is the database to run the extra-query on, and explain a list
+    to append a report of its plan to (see batch_select)
+    '''
+    if max_depth is not None and max_depth < 1:
+        raise ValueError('max_depth must be at least 1')
+    
     fieldname = _check_field_exists(model, fieldname)
+    field_object, _, direct, m2m = model._meta.get_field_by_name(fieldname)
+    if m2m or direct or field_object.model._meta.db_table != model._meta.db_table:
+        raise ValueError('"%s" is not a self-referential reverse ForeignKey' % fieldname)
+    fk_field = field_object.field
+    related_model = field_object.model
     
     instances = list(instances)
-    ids = [instance.pk for instance in instances]
+    for alias, db_instances in _group_by_db(instances, related_model, using):
+        if not db_instances:
+            # nothing to select (and an empty IN list isn't valid sql)
+            continue
+        related_instances = _select_tree(related_model, fk_field,
+                                         [instance.pk for instance in db_instances],
+                                         max_depth, alias)
+        if filter:
+            related_instances = filter(related_instances)
+        
+        if explain is not None:
+            report = explain_query(related_instances,
+                                   related_model._meta.db_table,
+                                   fk_field.column, len(db_instances))
+            report['field'] = target_field_name
+            report['strategy'] = 'recursive'
+            explain.append(report)
+        
+        grouped = _group_related_instances(related_instances, fk_field.attname)
+        
+        # walk down the tree a level at a time, attaching as we go
+        level, depth, seen = db_instances, 0, set()
+        while level and (max_depth is None or depth < max_depth):
+            next_level = []
+            for instance in level:
+                if id(instance) in seen:
+                    continue
+                seen.add(id(instance))
+                related = grouped.get(instance.pk, [])
+                setattr(instance, target_field_name, related)
+                next_level.extend(related)
+            level, depth = next_level, depth + 1
     
+    return instances
+
+def _m2m_columns(model, fieldname):
+    '''
+    returns (db_table, id_column, related_id_column, symmetrical, through)
+    for the many-to-many field on model
+    '''
+    fieldname = _check_field_exists(model, fieldname)
     field_object, model, direct, m2m = model._meta.get_field_by_name(fieldname)
-    if m2m:
-        if not direct:
-            m2m_field = field_object.field
-            related_model = field_object.model
-            related_name = m2m_field.name
-            id_column = m2m_field.m2m_reverse_name()
-            db_table = m2m_field.m2m_db_table()
-        else:
-            m2m_field = field_object
-            related_model = m2m_field.rel.to # model on other end of relationship
-            related_name = m2m_field.related_query_name()
-            id_column = m2m_field.m2m_column_name()
-            db_table  = m2m_field.m2m_db_table()
-    elif not direct:
-        # handle reverse foreign key relationships
-        fk_field = field_object.field
-        related_model = field_object.model
-        related_name  = fk_field.name
-        id_column = fk_field.column
-        db_table = related_model._meta.db_table
+    if not m2m:
+        raise FieldDoesNotExist('"%s" is not a ManyToManyField' % fieldname)
+    if direct:
+        m2m_field = field_object
+        id_column = m2m_field.m2m_column_name()
+        related_id_column = m2m_field.m2m_reverse_name()
+    else:
+        m2m_field = field_object.field
+        id_column = m2m_field.m2m_reverse_name()
+        related_id_column = m2m_field.m2m_column_name()
+    if not m2m_field.rel.through._meta.auto_created:
+        opts = m2m_field.rel.through._meta
+        raise ValueError('"%s" uses an intermediary model (%s.%s), '
+                         'update it directly instead' % 
+                         (fieldname, opts.app_label, opts.object_name))
+    symmetrical = direct and m2m_field.rel.symmetrical
+    return m2m_field.m2m_db_table(), id_column, related_id_column, \
+           symmetrical, m2m_field.rel.through
+
+def batch_update(model, instances, target_field_name, fieldname, values):
+    '''
+    the counterpart of batch_select for writing many-to-many fields
     
-    related_instances = _select_related_instances(related_model, related_name, 
-                                                  ids, db_table, id_column)
+    instances should already have fieldname batch selected into
+    target_field_name. values is a dict mapping the pk of an instance to
+    the related instances it should now have. The differences are
+    written with one INSERT and one DELETE for all of the instances
+    (split up if there are very many changes), rather than with
+    add()/remove() for each one.
     
-    if filter:
-        related_instances = filter(related_instances)
+    batch_update(Entry, entries, 'tags_all', 'tags',
+                 { entry.pk: [tag1, tag2], ... })
     
-    grouped = {}
-    id_attr = _id_attr(id_column)
-    for related_instance in related_instances:
-        instance_id = getattr(related_instance, id_attr)
-        group = grouped.get(instance_id, [])
-        group.append(related_instance)
-        grouped[instance_id] = group
+    instances that are not in values are left alone, and the
+    target_field_name lists are updated to match once the changes have
+    been written (if writing fails they are left as they were). The
+    changes are written to the database the routers choose for each
+    instance (so there is one INSERT and one DELETE per database). When
+    the instances come from more than one database values must be keyed
+    by (database, pk) instead, as a pk may be on more than one of them
     
+    NB: like QuerySet.update() this goes straight to the database, so
+    the m2m_changed signal is not sent
+    '''
+    db_table, id_column, related_id_column, symmetrical, through = \
+        _m2m_columns(model, fieldname)
+    
+    instances = list(instances)
+    mixed_dbs = len(set(instance._state.db for instance in instances)) > 1
+    
+    # the changes for each database, in the order first seen
+    changes, aliases = {}, []
     for instance in instances:
-        setattr(instance, target_field_name, grouped.get(instance.pk, []))
+        key = (instance._state.db, instance.pk)
+        if key not in values:
+            if instance.pk not in values:
+                continue
+            if mixed_dbs:
+                raise ValueError('the instances are from more than one '
+                                 'database, so values must be keyed by '
+                                 '(database, pk)')
+            key = instance.pk
+        alias = router.db_for_write(through, instance=instance)
+        if alias not in changes:
+            changes[alias] = ([], [], [])
+            aliases.append(alias)
+        to_insert, to_delete, updated = changes[alias]
+        current = getattr(instance, target_field_name)
+        wanted = list(values[key])
+        current_ids = set(related.pk for related in current)
+        wanted_ids = set(related.pk for related in wanted)
+        for related_id in wanted_ids - current_ids:
+            to_insert.append((instance.pk, related_id))
+        for related_id in current_ids - wanted_ids:
+            to_delete.append((instance.pk, related_id))
+        updated.append((instance, wanted))
+    
+    # two parameters per pair, so each statement stays within the
+    # parameter limit (and sqlite's expression depth limit)
+    chunk_size = MAX_IN_LIST // 2
+    for alias in aliases:
+        to_insert, to_delete, updated = changes[alias]
+        if symmetrical:
+            # keep the mirror entries up to date (as add()/remove() would)
+            to_insert = list(set(to_insert) |
+                             set((b, a) for a, b in to_insert))
+            to_delete = list(set(to_delete) |
+                             set((b, a) for a, b in to_delete))
+        
+        connection = connections[alias]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        try:
+            where = '(%s = %%s AND %s = %%s)' % (qn(id_column),
+                                                 qn(related_id_column))
+            for start in xrange(0, len(to_delete), chunk_size):
+                chunk = to_delete[start:start + chunk_size]
+                cursor.execute('DELETE FROM %s WHERE %s' % 
+                               (qn(db_table), ' OR '.join([where] * len(chunk))),
+                               [value for pair in chunk for value in pair])
+            for start in xrange(0, len(to_insert), chunk_size):
+                chunk = to_insert[start:start + chunk_size]
+                cursor.execute('INSERT INTO %s (%s, %s) VALUES %s' % 
+                               (qn(db_table), qn(id_column), qn(related_id_column),
+                                ', '.join(['(%s, %s)'] * len(chunk))),
+                               [value for pair in chunk for value in pair])
+        except:
+            # don't leave half the changes to be committed later
+            transaction.rollback_unless_managed(using=alias)
+            raise
+        if to_delete or to_insert:
+            transaction.commit_unless_managed(using=alias)
+        
+        # only now that it has been written
+        for instance, wanted in updated:
+            setattr(instance, target_field_name, wanted)
     
     return instances
 
@@ -115,15 +566,168 @@ class Batch(Replay):
     def __init__(self, m2m_fieldname, **filter):
         super(Batch,self).__init__()
         self.m2m_fieldname = m2m_fieldname
-        self.target_field_name = '%s_all' % m2m_fieldname
+        self.target_field_name = '%s_all' % m2m_fieldname.split('__')[-1]
+        self.use_merge = False
+        self.use_strategy = None
+        self.use_recursive = False
+        self.max_depth = None
+        self.use_db = None
         if filter: # add a filter replay method
             self._add_replay('filter', *(), **filter)
     
     def clone(self):
         cloned = super(Batch, self).clone(self.m2m_fieldname)
         cloned.target_field_name = self.target_field_name
+        cloned.use_merge = self.use_merge
+        cloned.use_strategy = self.use_strategy
+        cloned.use_recursive = self.use_recursive
+        cloned.max_depth = self.max_depth
+        cloned.use_db = self.use_db
+        return cloned
+    
+    def merge(self):
+        '''
+        stream the related instances ordered by the grouping column
+        instead of grouping them all in memory first
+        '''
+        cloned = self.clone()
+        cloned.use_merge = True
+        return cloned
+    
+    def strategy(self, strategy):
+        '''
+        always run the batch query using the given strategy (see
+        planner.STRATEGIES), instead of letting the planner choose
+        '''
+        cloned = self.clone()
+        cloned.use_strategy = strategy
+        return cloned
+    
+    def array_param(self):
+        '''
+        pass the ids to filter on as a single parameter (where supported)
+        '''
+        return self.strategy('array')
+    
+    def recursive(self, max_depth=None):
+        '''
+        select the whole tree for a self-referential reverse foreign key
+        in one query (see batch_select_recursive)
+        '''
+        cloned = self.clone()
+        cloned.use_recursive = True
+        cloned.max_depth = max_depth
+        return cloned
+    
+    def using(self, alias):
+        '''
+        run the batch query on the given database, rather than the one
+        chosen by the routers
+        '''
+        cloned = self.clone()
+        cloned.use_db = alias
         return cloned
 
+# the live sibling groups, so that they can be told about m2m changes
+_sibling_groups = weakref.WeakKeyDictionary()
+
+def _auto_batch_field_name(fieldname):
+    return '_auto_batch_%s' % fieldname
+
+class _SiblingGroup(object):
+    '''
+    the instances that came from the same auto-batched query
+    '''
+    def __init__(self, model, instances):
+        self.model = model
+        self.instances = instances
+        self.loaded = set()
+        self.warned = set()
+        _sibling_groups[self] = True
+    
+    def forget(self, fieldname, pks=None):
+        '''
+        drop the auto-batched fieldname of the instances with the given
+        pks (or of all of them), so it is selected again when next used
+        '''
+        target_field_name = _auto_batch_field_name(fieldname)
+        for instance in self.instances:
+            if pks is None or instance.pk in pks:
+                if instance.__dict__.pop(target_field_name, None) is not None:
+                    self.loaded.discard(fieldname)
+
+def _through_fieldnames(model, through):
+    # the names of the many-to-many fields (in either direction) on
+    # model that use the through table
+    names = [field.name for field in model._meta.many_to_many
+             if field.rel.through is through]
+    names.extend([related.field.related_query_name() for related
+                  in model._meta.get_all_related_many_to_many_objects()
+                  if related.field.rel.through is through])
+    return names
+
+def _forget_auto_batched(sender, instance, action, reverse, model, pk_set,
+                         **kwargs):
+    # writes through a related manager (add/remove/clear) make the
+    # auto-batched lists on both sides of the relationship stale
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if action == 'post_clear':
+        # everything on the other side may be affected
+        pk_set = None
+    for group in _sibling_groups.keys():
+        if isinstance(instance, group.model):
+            for fieldname in _through_fieldnames(group.model, sender):
+                group.forget(fieldname, set([instance.pk]))
+        if issubclass(model, group.model):
+            for fieldname in _through_fieldnames(group.model, sender):
+                group.forget(fieldname, pk_set)
+
+def _forget_auto_batched_fk(sender, instance, **kwargs):
+    # saving or deleting the child of a reverse foreign key makes the
+    # auto-batched lists of its new (and any old) parent stale
+    for group in _sibling_groups.keys():
+        for related in group.model._meta.get_all_related_objects():
+            if not issubclass(sender, related.model):
+                continue
+            fieldname = related.field.related_query_name()
+            target_field_name = _auto_batch_field_name(fieldname)
+            parent_value = getattr(instance, related.field.attname, None)
+            pks = set()
+            for parent in group.instances:
+                children = parent.__dict__.get(target_field_name) or ()
+                if getattr(parent, related.field.rel.field_name) == parent_value or \
+                   [child for child in children if child.pk == instance.pk]:
+                    pks.add(parent.pk)
+            if pks:
+                group.forget(fieldname, pks)
+
+models.signals.m2m_changed.connect(_forget_auto_batched)
+models.signals.post_save.connect(_forget_auto_batched_fk)
+models.signals.post_delete.connect(_forget_auto_batched_fk)
+
+def _related_manager_fieldname(model, manager):
+    # work out which field on model a related manager is for
+    through = getattr(manager, 'through', None)
+    if through is not None:
+        if manager.reverse:
+            for related in model._meta.get_all_related_many_to_many_objects():
+                if related.field.rel.through is through:
+                    return related.field.related_query_name()
+        else:
+            for field in model._meta.many_to_many:
+                if field.rel.through is through:
+                    return field.name
+    else:
+        core_filters = getattr(manager, 'core_filters', None) or {}
+        for key in core_filters:
+            rel_field_name = key.split('__')[0]
+            for related in model._meta.get_all_related_objects():
+                if related.model is manager.model and \
+                   related.field.name == rel_field_name:
+                    return related.field.related_query_name()
+    return None
+
 class BatchQuerySet(QuerySet):
     
     def _clone(self, *args, **kwargs):
@@ -131,8 +735,47 @@ class BatchQuerySet(QuerySet):
         batches = getattr(self, '_batches', None)
         if batches:
             query._batches = set(batches)
+        query._auto_batch = getattr(self, '_auto_batch', False)
+        query._explain_batches = getattr(self, '_explain_batches', False)
+        query._reuse_batches = getattr(self, '_reuse_batches', False)
+        # only passed on by the methods that narrow the results
+        # (see _narrowed)
+        query._batch_source = None
+        return query
+    
+    def _narrowed(self, query):
+        '''
+        let query, which selects a subset of our results (on the same
+        database), re-use our batch selected fields if reuse_batches()
+        was used
+        '''
+        source = getattr(self, '_batch_source', None)
+        batches = getattr(self, '_batches', None)
+        if getattr(self, '_reuse_batches', False) and batches and \
+           self._result_cache is not None and not self._iter:
+            # we've been evaluated, so let the new query use our results
+            # (the same lookup is shared by all the derived queries)
+            source = getattr(self, '_batch_results', None)
+            if source is None:
+                source = self._batch_results = \
+                    (set(batches),
+                     dict(((result._state.db, result.pk), result)
+                          for result in self._result_cache))
+        if query.db == self.db:
+            query._batch_source = source
         return query
     
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        query = super(BatchQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+        return self._narrowed(query)
+    
+    def __getitem__(self, k):
+        result = super(BatchQuerySet, self).__getitem__(k)
+        if isinstance(result, BatchQuerySet):
+            # a slice of a query that hasn't been evaluated yet
+            result = self._narrowed(result)
+        return result
+    
     def _create_batch(self, batch_or_str, target_field_name=None):
         batch = batch_or_str
         if isinstance(batch_or_str, basestring):
@@ -140,7 +783,7 @@ class BatchQuerySet(QuerySet):
         if target_field_name:
             batch.target_field_name = target_field_name
         
-        _check_field_exists(self.model, batch.m2m_fieldname)
+        _resolve_path(self.model, batch.m2m_fieldname)
         return batch
     
     def batch_select(self, *batches, **named_batches):
@@ -149,20 +792,121 @@ class BatchQuerySet(QuerySet):
                   set(self._create_batch(batch, target_field_name) \
                         for target_field_name, batch in named_batches.items())
         
-        query = self._clone()
+        # the same objects, so any batches already selected can be re-used
+        query = self._narrowed(self._clone())
         query._batches = batches
         return query
     
+    def auto_batch(self):
+        '''
+        when a related manager's all() is first used on one of the
+        resulting instances, batch select that relationship for all of
+        the instances, instead of doing a query per instance
+        '''
+        query = self._clone()
+        query._auto_batch = True
+        return query
+    
+    def explain_batches(self):
+        '''
+        capture the query plan of each batch query, when this queryset is
+        evaluated they can be found in the batch_explain attribute
+        '''
+        query = self._clone()
+        query._explain_batches = True
+        return query
+    
+    def reuse_batches(self):
+        '''
+        once this queryset has been evaluated, querysets derived from it
+        with filter(), exclude(), slicing or batch_select() re-use its
+        batch selected fields for any instances it already has, rather
+        than running the batch queries again
+        '''
+        query = self._clone()
+        query._reuse_batches = True
+        return query
+    
+    def _reuse_batch(self, batch, results, source_results, explain):
+        # only select the batch for results we don't already have
+        missing = []
+        for result in results:
+            source = source_results.get((result._state.db, result.pk))
+            if source is None:
+                missing.append(result)
+            else:
+                setattr(result, batch.target_field_name,
+                        list(getattr(source, batch.target_field_name)))
+        if missing:
+            self._select_batch(batch, missing, explain)
+    
+    def _select_batch(self, batch, results, explain):
+        path, model, fieldname = _resolve_path(self.model, batch.m2m_fieldname)
+        instances, duplicates, parent_query = results, [], self
+        if path:
+            # select for the (distinct) objects at the end of the path,
+            # which can't be found with a subquery on this query
+            instances, duplicates = _follow_path(results, path)
+            parent_query = None
+        
+        # plan for the database (most of) the batch query will be run on
+        using = batch.use_db
+        if using is None and instances:
+            related_model = _related_field_info(model, fieldname)[0]
+            using = router.db_for_read(related_model, instance=instances[0])
+        
+        if batch.use_recursive:
+            self.batch_plans[batch.target_field_name] = \
+                plan_recursive(len(instances), batch.max_depth, using)
+            batch_select_recursive(model, instances,
+                                   batch.target_field_name,
+                                   fieldname,
+                                   batch.replay,
+                                   batch.max_depth,
+                                   using=batch.use_db,
+                                   explain=explain)
+        else:
+            plan = plan_batch(model, fieldname, len(instances),
+                              batch.use_strategy, parent_query, using)
+            self.batch_plans[batch.target_field_name] = plan
+            batch_select(model, instances,
+                         batch.target_field_name,
+                         fieldname,
+                         batch.replay,
+                         merge=batch.use_merge,
+                         explain=explain,
+                         plan=plan,
+                         parent_query=parent_query,
+                         using=batch.use_db)
+        
+        for duplicate, instance in duplicates:
+            setattr(duplicate, batch.target_field_name,
+                    getattr(instance, batch.target_field_name))
+        return results
+    
     def iterator(self):
         result_iter = super(BatchQuerySet, self).iterator()
         batches = getattr(self, '_batches', None)
-        if batches:
+        auto_batch = getattr(self, '_auto_batch', False)
+        if batches or auto_batch:
             results = list(result_iter)
-            for batch in batches:
-                results = batch_select(self.model, results,
-                                       batch.target_field_name,
-                                       batch.m2m_fieldname,
-                                       batch.replay)
+            explain = None
+            if getattr(self, '_explain_batches', False):
+                explain = self.batch_explain = []
+            self.batch_plans = {}
+            source_batches, source_results = \
+                getattr(self, '_batch_source', None) or (set(), {})
+            for batch in batches or ():
+                # batches through a path are attached to other objects,
+                # so are always selected again
+                if batch in source_batches and '__' not in batch.m2m_fieldname:
+                    self._reuse_batch(batch, results, source_results, explain)
+                else:
+                    results = self._select_batch(batch, results, explain)
+            if auto_batch:
+                siblings = _SiblingGroup(self.model, results)
+                for result in results:
+                    result._batch_siblings = siblings
             return iter(results)
         return result_iter
 
@@ -172,8 +916,45 @@ class BatchManager(models.Manager):
     def get_query_set(self):
         return BatchQuerySet(self.model)
     
+    def all(self):
+        query = super(BatchManager, self).all()
+        # see if we are a related manager for an auto-batched instance
+        instance = getattr(self, 'instance', None)
+        siblings = getattr(instance, '_batch_siblings', None)
+        if siblings is None:
+            return query
+        fieldname = _related_manager_fieldname(siblings.model, self)
+        if fieldname is None:
+            return query
+        target_field_name = _auto_batch_field_name(fieldname)
+        if fieldname not in siblings.loaded:
+            if fieldname not in siblings.warned:
+                logger.warning('auto batching "%s" for %d %s instances, '
+                               'use batch_select(\'%s\') instead',
+                               fieldname, len(siblings.instances),
+                               siblings.model._meta.object_name, fieldname)
+                siblings.warned.add(fieldname)
+            # only those that haven't got it (or have had it changed)
+            missing = [sibling for sibling in siblings.instances
+                       if not hasattr(sibling, target_field_name)]
+            if missing:
+                batch_select(siblings.model, missing,
+                             target_field_name, fieldname)
+            siblings.loaded.add(fieldname)
+        query._result_cache = list(getattr(instance, target_field_name))
+        return query
+    
     def batch_select(self, *batches, **named_batches):
         return self.all().batch_select(*batches, **named_batches)
+    
+    def auto_batch(self):
+        return self.all().auto_batch()
+    
+    def explain_batches(self):
+        return self.all().explain_batches()
+    
+    def reuse_batches(self):
+        return self.all().reuse_batches()
 
 if getattr(settings, 'TESTING_BATCH_SELECT', False):
     class Tag(models.Model):
@@ -197,6 +978,13 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
         
         objects = BatchManager()
     
+    class Category(models.Model):
+        name = models.CharField(max_length=32)
+        parent = models.ForeignKey('self', blank=True, null=True,
+                                   related_name='children')
+        
+        objects = BatchManager()
+    
     class Country(models.Model):
         # non id pk
         name = models.CharField(primary_key=True, max_length=100)
@@ -0,0 +1,129 @@
+'''
+Choose how each batch query is run, based on the number of objects the
+related objects are being selected for, what the database supports and
+how many related objects each object has had in the past.
+'''
+from django.db import connections, DEFAULT_DB_ALIAS
+
+from backend import _vendor, supports_array_param, supports_temp_table
+
+# in         - one query with an IN list of ids
+# chunked    - one query with an IN list for each chunk of ids
+# array      - one query with the ids passed as a single parameter
+# subquery   - one query using the original query as a subquery
+# temp_table - one query against a temporary table of ids
+STRATEGIES = ('in', 'chunked', 'array', 'subquery', 'temp_table')
+# (recursive batches are always one WITH RECURSIVE query, see plan_recursive)
+
+# the most ids to put in one IN list (sqlite before 3.32 can only
+# have 999 parameters)
+MAX_IN_LIST = 999
+
+# try to keep queries to at most this many related objects
+MAX_ROWS_PER_QUERY = 10000
+
+# use a temporary table when there are at least this many ids
+TEMP_TABLE_MIN_IDS = 10000
+
+_fanout_history = {}
+
+def _history_key(model, fieldname):
+    return (model._meta.db_table, fieldname)
+
+def record_fanout(model, fieldname, parents, related):
+    '''
+    remember how many related objects were selected for parents objects
+    '''
+    key = _history_key(model, fieldname)
+    seen_parents, seen_related = _fanout_history.get(key, (0, 0))
+    _fanout_history[key] = (seen_parents + parents, seen_related + related)
+
+def expected_fanout(model, fieldname):
+    '''
+    the average number of related objects per object seen so far, or
+    None if fieldname hasn't been batch selected yet
+    '''
+    seen_parents, seen_related = _fanout_history.get(
+                                    _history_key(model, fieldname), (0, 0))
+    if not seen_parents:
+        return None
+    return float(seen_related) / seen_parents
+
+def _can_subquery(parent_query, using):
+    if parent_query is None or parent_query.db != using:
+        return False
+    if _vendor(connections[using]) == 'mysql':
+        # mysql can't use LIMIT in an IN subquery and is slow at them anyway
+        return False
+    query = parent_query.query
+    return not query.low_mark and query.high_mark is None
+
+def _choose_temp_table(connection):
+    # only chosen by default where it has been checked (mysql needs care
+    # not to commit the transaction, and oracle has different syntax)
+    vendor = _vendor(connection)
+    return vendor.startswith('sqlite') or vendor.startswith('postgresql')
+
+def plan_batch(model, fieldname, parents, strategy=None, parent_query=None,
+               using=None):
+    '''
+    returns a dict describing how the batch query for selecting fieldname
+    for a number (parents) of model instances should be run. Includes
+    the 'strategy' (one of STRATEGIES), 'chunk_size' for chunked queries
+    and a 'reason' for the choice.
+    
+    parent_query is the queryset the instances came from, which may be
+    used as a subquery (if it is on the same database). using is the
+    database the batch query will be run on. strategy can be given to
+    override the choice.
+    '''
+    using = using or DEFAULT_DB_ALIAS
+    fanout = expected_fanout(model, fieldname)
+    chunk_size = MAX_IN_LIST
+    if fanout:
+        chunk_size = max(1, min(MAX_IN_LIST, int(MAX_ROWS_PER_QUERY / fanout)))
+    
+    if strategy is not None:
+        if strategy not in STRATEGIES:
+            raise ValueError('unknown batch strategy "%s", expected one of %s' %
+                             (strategy, ', '.join(STRATEGIES)))
+        if strategy == 'subquery' and not _can_subquery(parent_query, using):
+            raise ValueError('subquery strategy needs an unsliced parent query '
+                             'on the same database')
+        if strategy == 'temp_table' and \
+           not supports_temp_table(connections[using]):
+            raise ValueError('temp_table strategy is not supported by %s' %
+                             _vendor(connections[using]))
+        reason = 'chosen for batch'
+    elif parents <= chunk_size:
+        strategy, reason = 'in', 'few objects'
+    elif fanout and parents * fanout > MAX_ROWS_PER_QUERY:
+        strategy, reason = 'chunked', 'many related objects per object'
+    elif _can_subquery(parent_query, using):
+        strategy, reason = 'subquery', 'many objects from an unsliced query'
+    elif supports_array_param(connections[using]):
+        strategy, reason = 'array', 'many objects'
+    elif parents >= TEMP_TABLE_MIN_IDS and _choose_temp_table(connections[using]):
+        strategy, reason = 'temp_table', 'very many objects'
+    else:
+        strategy, reason = 'chunked', 'many objects'
+    
+    return { 'strategy': strategy,
+             'parents': parents,
+             'chunk_size': chunk_size,
+             'fanout': fanout,
+             'using': using,
+             'reason': reason }
+
+def plan_recursive(parents, max_depth=None, using=None):
+    '''
+    returns a dict like plan_batch does, for a recursive batch (which
+    is always run as one WITH RECURSIVE query)
+    '''
+    return { 'strategy': 'recursive',
+             'parents': parents,
+             'chunk_size': None,
+             'fanout': None,
+             'max_depth': max_depth,
+             'using': using or DEFAULT_DB_ALIAS,
+             'reason': 'recursive batch' }
@@ -0,0 +1,175 @@
+'''
+Compact serialization of batch selected objects, so that they can be
+cached (e.g. in memcached) without pickling every instance and
+duplicated related instance along with the BatchQuerySet itself.
+
+Each model's rows are written once, in columnar form, and the batch
+selected fields are written as lists of row indexes.
+'''
+import cPickle as pickle
+
+from django.db.models import get_model
+from django.db.models.query_utils import deferred_class_factory
+
+from models import _related_field_info
+
+FORMAT_VERSION = 2
+
+def _nested_batches(related_model, batch):
+    # find out what was batch selected on the related instances
+    query = related_model._default_manager.all()
+    for method_name, args, kwargs in batch._replays:
+        if method_name == 'batch_select':
+            query = query.batch_select(*args, **kwargs)
+    batches = list(getattr(query, '_batches', ()))
+    if batch.use_recursive:
+        # the related instances have the batch selected on them too
+        # (down to max_depth)
+        batches.append(batch)
+    return batches
+
+def _deferred_attnames(instance, attnames):
+    if not getattr(instance, '_deferred', False):
+        return ()
+    return tuple(attname for attname in attnames
+                 if attname not in instance.__dict__)
+
+class _Table(object):
+    def __init__(self, model):
+        self.model = model
+        self.attnames = [field.attname for field in model._meta.fields]
+        self.instances = []
+        self.rows = {}
+        self.links = {}
+        self.linked = {}
+
+    def add(self, instance):
+        row = self.rows.get(instance.pk)
+        if row is None:
+            row = self.rows[instance.pk] = len(self.instances)
+            self.instances.append(instance)
+        return row
+
+    def dump(self):
+        opts = self.model._meta
+        # deferred fields (from only() or defer()) aren't loaded, so that
+        # they aren't each selected with their own query
+        deferred = [_deferred_attnames(instance, self.attnames)
+                    for instance in self.instances]
+        columns = [[instance.__dict__.get(attname)
+                    for instance in self.instances]
+                   for attname in self.attnames]
+        dbs = [instance._state.db for instance in self.instances]
+        links = [(target_field_name, child_table, parent_rows, child_rows)
+                 for target_field_name, (child_table, parent_rows, child_rows)
+                 in self.links.items()]
+        return (opts.app_label, opts.object_name, self.attnames,
+                columns, deferred, dbs, links)
+
+class _Packer(object):
+    def __init__(self):
+        self.tables = []
+        self.table_indexes = {}
+
+    def table(self, model):
+        index = self.table_indexes.get(model)
+        if index is None:
+            index = self.table_indexes[model] = len(self.tables)
+            self.tables.append(_Table(model))
+        return index
+
+    def add(self, instances, model, batches):
+        table_index = self.table(model)
+        table = self.tables[table_index]
+        rows = [table.add(instance) for instance in instances]
+        for batch in batches:
+            if '__' in batch.m2m_fieldname:
+                # attached to objects reached through select_related,
+                # which aren't serialized
+                continue
+            related_model = _related_field_info(model, batch.m2m_fieldname)[0]
+            child_table = self.table(related_model)
+            # the same field may be reached more than once (e.g. via
+            # different nested batches), but each row is only linked once
+            links = table.links.setdefault(batch.target_field_name,
+                                           (child_table, [], []))
+            linked = table.linked.setdefault(batch.target_field_name, set())
+            parents, children, seen = [], [], set()
+            for instance, row in zip(instances, rows):
+                related = getattr(instance, batch.target_field_name, None)
+                if related is None or row in linked:
+                    continue
+                linked.add(row)
+                parents.append((row, related))
+                for child in related:
+                    if child.pk not in seen:
+                        seen.add(child.pk)
+                        children.append(child)
+            # only go through each (shared) child once
+            child_rows = {}
+            if children:
+                nested = _nested_batches(related_model, batch)
+                _, child_rows = self.add(children, related_model, nested)
+                child_rows = dict(zip([child.pk for child in children],
+                                      child_rows))
+            for row, related in parents:
+                links[1].append(row)
+                links[2].append([child_rows[child.pk] for child in related])
+        return table_index, rows
+
+def dumps(queryset):
+    '''
+    serialize the (batch selected) results of queryset, returning a string
+    that can be passed to loads() to get the instances back
+
+    the values of the model fields and of any batch selected fields
+    (including nested batch selects) are kept - annotations and extra
+    selects are not
+    '''
+    packer = _Packer()
+    batches = getattr(queryset, '_batches', ())
+    table_index, rows = packer.add(list(queryset), queryset.model, batches)
+    data = (FORMAT_VERSION, table_index, rows,
+            [table.dump() for table in packer.tables])
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+def loads(data):
+    '''
+    rebuild a list of instances (with their batch selected fields)
+    from a string created by dumps()
+
+    each related instance is only created once, so instances that were
+    related to more than one object will be shared between them
+    '''
+    version, table_index, rows, tables = pickle.loads(data)
+    if version != FORMAT_VERSION:
+        raise ValueError('unsupported serialization format %r' % version)
+
+    all_instances = []
+    for app_label, object_name, attnames, columns, deferred, dbs, links in tables:
+        model = get_model(app_label, object_name)
+        instances = []
+        for values, deferred_attnames in zip(zip(*columns), deferred):
+            if deferred_attnames:
+                # recreate the deferred instance, as only()/defer() would
+                values = dict((attname, value) for attname, value
+                              in zip(attnames, values)
+                              if attname not in deferred_attnames)
+                klass = deferred_class_factory(model, deferred_attnames)
+                instances.append(klass(**values))
+            else:
+                instances.append(model(*values))
+        for instance, db in zip(instances, dbs):
+            instance._state.db = db
+            instance._state.adding = False
+        all_instances.append(instances)
+
+    for (_, _, _, _, _, _, links), instances in zip(tables, all_instances):
+        for target_field_name, child_table, parent_rows, child_rows in links:
+            children = all_instances[child_table]
+            for parent_row, related_rows in zip(parent_rows, child_rows):
+                setattr(instances[parent_row], target_field_name,
+                        [children[row] for row in related_rows])
+
+    root = all_instances[table_index]
+    return [root[row] for row in rows]
@@ -5,8 +5,25 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
     from django.db.models.fields import FieldDoesNotExist
     from batch_select.models import Tag, Entry, Section, Batch, Location,\
                                     _select_related_instances, Country,\
-                                    _check_field_exists
+                                    _check_field_exists, batch_update,\
+                                    Category, batch_select
     from batch_select.replay import Replay
+    from batch_select import serialize
+    from batch_select.explain import _is_seq_scan
+    from batch_select import planner
+    from batch_select import backend
+    from batch_select.export import export, _partitions, FORMATS
+    from django.core.management import call_command
+    from django.core.management.base import CommandError
+    from batch_select.management.commands.batch_export import Command as BatchExportCommand
+    from django.utils import simplejson
+    from cStringIO import StringIO
+    import cPickle
+    import csv
+    import itertools
+    import logging
+    import os
+    import tempfile
     from django import db
     from django.db.models import Count
     import unittest
@@ -151,6 +168,57 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             entry1 = list(new_qs)[0]
             self.failUnlessEqual(set([tag1, tag2, tag3]), set(entry1.tags_all))
         
+        @with_debug_queries
+        def test_batch_select_after_new_query_reuse_batches(self):
+            entry1, entry2, entry3 = _create_entries(3)
+            tag1, tag2, tag3 = _create_tags('tag1', 'tag2', 'tag3')
+            
+            entry1.tags.add(tag1, tag2, tag3)
+            entry2.tags.add(tag2)
+            
+            qs = Entry.objects.batch_select(Batch('tags')).reuse_batches().order_by('id')
+            self.failUnlessEqual([entry1, entry2, entry3], list(qs))
+            
+            db.reset_queries()
+            new_qs = qs.filter(id__in=[entry1.id, entry2.id])
+            entry1, entry2 = list(new_qs)
+            # only the query for the entries
+            self.failUnlessEqual(1, len(db.connection.queries))
+            self.failUnlessEqual(set([tag1, tag2, tag3]), set(entry1.tags_all))
+            self.failUnlessEqual(set([tag2]),             set(entry2.tags_all))
+            
+            # entries that weren't in the original results still get
+            # their tags selected, as do any new batches
+            entry4 = Entry.objects.create()
+            entry4.tags.add(tag3)
+            db.reset_queries()
+            new_qs = qs.filter(id__in=[entry1.id, entry4.id]).batch_select(tags2='tags')
+            entry1, entry4 = list(new_qs)
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnlessEqual(set([tag1, tag2, tag3]), set(entry1.tags_all))
+            self.failUnlessEqual(set([tag1, tag2, tag3]), set(entry1.tags2))
+            self.failUnlessEqual([tag3],                  entry4.tags_all)
+        
+        @with_debug_queries
+        def test_reuse_batches_only_when_narrowed(self):
+            entry1, entry2 = _create_entries(2)
+            tag1, = _create_tags('tag1')
+            entry1.tags.add(tag1)
+            
+            qs = Entry.objects.batch_select('tags').reuse_batches().order_by('id')
+            list(qs)
+            
+            db.reset_queries()
+            entry1, = list(qs.exclude(id=entry2.id)[:1])
+            self.failUnlessEqual([tag1], entry1.tags_all)
+            self.failUnlessEqual(1, len(db.connection.queries))
+            
+            # anything else runs the batch queries again
+            db.reset_queries()
+            entry2, entry1 = list(qs.order_by('-id'))
+            self.failUnlessEqual([tag1], entry1.tags_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
         @with_debug_queries
         def test_batch_select_minimal_queries(self):
             # make sure we are only doing the number of sql queries we intend to
@@ -387,6 +455,341 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             self.failUnlessEqual([self.tag3, self.tag2],            entry3.tags_all)
             self.failUnlessEqual([],                                entry4.tags_all)
         
+        def test_batch_merge(self):
+            entries = Entry.objects.batch_select(Batch('tags').merge().order_by('name')).order_by('id')
+            entries = list(entries)
+
+            self.failUnlessEqual([self.entry1, self.entry2, self.entry3, self.entry4],
+                                  entries)
+
+            entry1, entry2, entry3, entry4 = entries
+
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+        
+        @with_debug_queries
+        def test_batch_merge_one_to_many(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            section3 = Section.objects.create(name='s3')
+            
+            entry1 = Entry.objects.create(section=section3)
+            entry2 = Entry.objects.create(section=section1)
+            entry3 = Entry.objects.create(section=section3)
+            
+            db.reset_queries()
+            
+            sections = Section.objects.batch_select(Batch('entry').merge()).order_by('id')
+            sections = list(sections)
+            self.failUnlessEqual([section1, section2, section3], sections)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            section1, section2, section3 = sections
+            
+            self.failUnlessEqual([entry2],         section1.entry_all)
+            self.failUnlessEqual([],               section2.entry_all)
+            self.failUnlessEqual(set([entry1, entry3]), set(section3.entry_all))
+        
+        @with_debug_queries
+        def test_auto_batch(self):
+            db.reset_queries()
+            
+            entries = list(Entry.objects.auto_batch().order_by('id'))
+            self.failUnlessEqual(1, len(db.connection.queries))
+            
+            entry1, entry2, entry3, entry4 = entries
+            
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(entry1.tags.all()))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual(set([self.tag2]),            set(entry2.tags.all()))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry3.tags.all()))
+            self.failUnlessEqual(set([]),                     set(entry4.tags.all()))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            # anything other than all() still goes to the database
+            self.failUnlessEqual([self.tag1],
+                                 list(entry1.tags.all().filter(name='tag1')))
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_auto_batch_reverse_m2m(self):
+            db.reset_queries()
+            
+            tags = list(Tag.objects.auto_batch().order_by('name'))
+            tag1, tag2, tag3 = tags
+            
+            self.failUnlessEqual(set([self.entry1]), set(tag1.entry_set.all()))
+            self.failUnlessEqual(set([self.entry1, self.entry2, self.entry3]),
+                                 set(tag2.entry_set.all()))
+            self.failUnlessEqual(set([self.entry1, self.entry3]),
+                                 set(tag3.entry_set.all()))
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_auto_batch_after_changes(self):
+            entries = list(Entry.objects.auto_batch().order_by('id'))
+            entry1, entry2, entry3, entry4 = entries
+            self.failUnlessEqual([self.tag2], list(entry2.tags.all()))
+            
+            entry2.tags.add(self.tag1)
+            db.reset_queries()
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(entry2.tags.all()))
+            # only the changed instance is selected again
+            self.failUnlessEqual(1, len(db.connection.queries))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(entry3.tags.all()))
+            self.failUnlessEqual(1, len(db.connection.queries))
+            self.failUnlessEqual(2, entry2.tags.all().count())
+            self.failUnlessEqual(2, entry2.tags.count())
+            
+            entry3.tags.remove(self.tag2)
+            self.failUnlessEqual([self.tag3], list(entry3.tags.all()))
+            entry1.tags.clear()
+            self.failUnlessEqual([], list(entry1.tags.all()))
+        
+        def test_auto_batch_after_reverse_changes(self):
+            tags = list(Tag.objects.auto_batch().order_by('name'))
+            tag1, tag2, tag3 = tags
+            self.failUnlessEqual(set([self.entry1]), set(tag1.entry_set.all()))
+            
+            # changed from the other side of the relationship
+            self.entry4.tags.add(self.tag1)
+            self.failUnlessEqual(set([self.entry1, self.entry4]),
+                                 set(tag1.entry_set.all()))
+            self.entry1.tags.clear()
+            self.failUnlessEqual(set([self.entry4]), set(tag1.entry_set.all()))
+            self.failUnlessEqual(set([self.entry2, self.entry3]),
+                                 set(tag2.entry_set.all()))
+        
+        def test_auto_batch_after_fk_changes(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            entry = Entry.objects.create(section=section1)
+            sections = list(Section.objects.auto_batch().order_by('id'))
+            section1, section2 = sections
+            # what all() on a reverse foreign key manager would do (where
+            # the manager knows its instance, with Django 1.4 and above)
+            siblings = section1._batch_siblings
+            batch_select(Section, sections, '_auto_batch_entry', 'entry')
+            siblings.loaded.add('entry')
+            
+            entry.section = section2
+            entry.save()
+            self.failIf(hasattr(section1, '_auto_batch_entry'))
+            self.failIf(hasattr(section2, '_auto_batch_entry'))
+            self.failIf('entry' in siblings.loaded)
+            
+            batch_select(Section, sections, '_auto_batch_entry', 'entry')
+            siblings.loaded.add('entry')
+            Entry.objects.create(section=section1)
+            self.failIf(hasattr(section1, '_auto_batch_entry'))
+            self.failUnlessEqual([entry], section2._auto_batch_entry)
+            
+            entry.delete()
+            self.failIf(hasattr(section2, '_auto_batch_entry'))
+        
+        def test_auto_batch_warning(self):
+            records = []
+            class _Handler(logging.Handler):
+                def emit(self, record):
+                    records.append(record)
+            handler = _Handler()
+            logger = logging.getLogger('batch_select')
+            logger.addHandler(handler)
+            try:
+                entry1, entry2, entry3, entry4 = Entry.objects.auto_batch()
+                entry1.tags.all()
+                entry2.tags.all()
+            finally:
+                logger.removeHandler(handler)
+            
+            self.failUnlessEqual(1, len(records))
+            self.failUnlessEqual(logging.WARNING, records[0].levelno)
+            self.failUnlessEqual('auto batching "tags" for 4 Entry instances, '
+                                 'use batch_select(\'tags\') instead',
+                                 records[0].getMessage())
+        
+        @with_debug_queries
+        def test_no_auto_batch(self):
+            db.reset_queries()
+            
+            entry1, entry2, entry3, entry4 = list(Entry.objects.order_by('id'))
+            self.failUnlessEqual(set([self.tag2]), set(entry2.tags.all()))
+            self.failUnlessEqual(set([]),          set(entry4.tags.all()))
+            self.failUnlessEqual(3, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_update(self):
+            entries = list(Entry.objects.batch_select('tags').order_by('id'))
+            entry1, entry2, entry3, entry4 = entries
+            
+            db.reset_queries()
+            batch_update(Entry, entries, 'tags_all', 'tags',
+                         { entry1.pk: [self.tag1],
+                           entry2.pk: [self.tag2],
+                           entry4.pk: [self.tag1, self.tag3] })
+            # one DELETE and one INSERT
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.tag1], entry1.tags_all)
+            self.failUnlessEqual([self.tag1, self.tag3], entry4.tags_all)
+            
+            self.failUnlessEqual(set([self.tag1]),            set(self.entry1.tags.all()))
+            self.failUnlessEqual(set([self.tag2]),            set(self.entry2.tags.all()))
+            self.failUnlessEqual(set([self.tag2, self.tag3]), set(self.entry3.tags.all()))
+            self.failUnlessEqual(set([self.tag1, self.tag3]), set(self.entry4.tags.all()))
+        
+        @with_debug_queries
+        def test_batch_update_reverse_m2m(self):
+            tags = list(Tag.objects.batch_select('entry').order_by('name'))
+            tag1, tag2, tag3 = tags
+            
+            db.reset_queries()
+            batch_update(Tag, tags, 'entry_all', 'entry',
+                         { tag3.pk: [self.entry4] })
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual(set([self.tag1, self.tag2]), set(self.entry1.tags.all()))
+            self.failUnlessEqual(set([self.tag2]),            set(self.entry3.tags.all()))
+            self.failUnlessEqual(set([self.tag3]),            set(self.entry4.tags.all()))
+        
+        @with_debug_queries
+        def test_batch_update_no_changes(self):
+            entries = list(Entry.objects.batch_select('tags').order_by('id'))
+            
+            db.reset_queries()
+            batch_update(Entry, entries, 'tags_all', 'tags',
+                         { self.entry2.pk: [self.tag2] })
+            self.failUnlessEqual(0, len(db.connection.queries))
+        
+        @with_debug_queries
+        def test_batch_update_many_pairs(self):
+            entries = _create_entries(40)
+            tags = _create_tags(*['many%d' % i for i in xrange(30)])
+            for entry in entries:
+                entry.tags.add(*tags)
+            entries = list(Entry.objects.filter(pk__in=[e.pk for e in entries])
+                                        .batch_select('tags'))
+            
+            # 1200 pairs to delete, then to insert again
+            db.reset_queries()
+            batch_update(Entry, entries, 'tags_all', 'tags',
+                         dict((entry.pk, []) for entry in entries))
+            self.failUnlessEqual(3, len(db.connection.queries))
+            self.failUnlessEqual(0, Entry.tags.through.objects.filter(
+                                        tag__in=tags).count())
+            
+            batch_update(Entry, entries, 'tags_all', 'tags',
+                         dict((entry.pk, tags) for entry in entries))
+            self.failUnlessEqual(1200, Entry.tags.through.objects.filter(
+                                           tag__in=tags).count())
+            self.failUnlessEqual(tags, entries[0].tags_all)
+        
+        def test_batch_update_failure(self):
+            entries = list(Entry.objects.batch_select('tags').order_by('id'))
+            entry1 = entries[0]
+            tags_all = list(entry1.tags_all)
+            try:
+                # the unsaved tag makes the INSERT fail after the DELETE
+                batch_update(Entry, entries, 'tags_all', 'tags',
+                             { entry1.pk: [self.tag1, Tag(name='unsaved')] })
+                self.fail('wrote a tag that has not been saved')
+            except db.IntegrityError:
+                pass
+            self.failUnlessEqual(tags_all, entry1.tags_all)
+            # and the DELETE was rolled back, rather than left to be committed
+            db.transaction.commit_unless_managed()
+            self.failUnlessEqual(set([self.tag1, self.tag2, self.tag3]),
+                                 set(self.entry1.tags.all()))
+        
+        def test_batch_update_non_m2m_field(self):
+            sections = list(Section.objects.batch_select('entry'))
+            try:
+                batch_update(Section, sections, 'entry_all', 'entry', {})
+                self.fail('updated field that is not m2m field')
+            except FieldDoesNotExist:
+                pass
+        
+        def test_explain_batches(self):
+            qs = Entry.objects.batch_select('tags').explain_batches()
+            self.failUnlessEqual(4, len(list(qs)))
+            
+            self.failUnlessEqual(1, len(qs.batch_explain))
+            report = qs.batch_explain[0]
+            self.failUnlessEqual('tags_all', report['field'])
+            self.failUnlessEqual('batch_select_entry_tags', report['table'])
+            self.failUnlessEqual('entry_id', report['column'])
+            self.failUnlessEqual(4, report['parents'])
+            self.failIf(not report['plan'])
+            self.failIf(report['seq_scan'], report['plan'])
+        
+        def test_explain_batches_empty(self):
+            qs = Section.objects.batch_select('entry').explain_batches()
+            self.failUnlessEqual([], list(qs))
+            self.failUnlessEqual(0, qs.batch_explain[0]['parents'])
+            self.failUnlessEqual([], qs.batch_explain[0]['plan'])
+        
+        def test_is_seq_scan(self):
+            table = 'batch_select_entry_tags'
+            self.failUnless(_is_seq_scan('sqlite', [], [(0, 0, 0, 'SCAN TABLE %s' % table)], table))
+            self.failUnless(_is_seq_scan('sqlite', [], [(2, 0, 0, 'SCAN %s' % table)], table))
+            self.failIf(_is_seq_scan('sqlite', [], [(0, 0, 0, 'SCAN TABLE batch_select_tag')], table))
+            self.failIf(_is_seq_scan('sqlite', [], [(0, 0, 0, 'SEARCH %s USING INDEX x (entry_id=?)' % table)], table))
+            self.failIf(_is_seq_scan('sqlite', [], [(0, 0, 0, 'SCAN %s USING COVERING INDEX x' % table)], table))
+            
+            self.failUnless(_is_seq_scan('postgresql', ['QUERY PLAN'], [('  ->  Seq Scan on %s  (cost=0.00..1.01)' % table,)], table))
+            self.failIf(_is_seq_scan('postgresql', ['QUERY PLAN'], [('  ->  Index Scan using x on %s' % table,)], table))
+            
+            columns = ['id', 'select_type', 'table', 'type', 'possible_keys', 'key']
+            self.failUnless(_is_seq_scan('mysql', columns, [(1, 'SIMPLE', table, 'ALL', None, None)], table))
+            self.failIf(_is_seq_scan('mysql', columns, [(1, 'SIMPLE', table, 'ref', 'x', 'x')], table))
+        
+        @with_debug_queries
+        def test_batch_array_param(self):
+            batch = Batch('tags').array_param().order_by('name')
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            entries = list(entries)
+            
+            entry1, entry2, entry3, entry4 = entries
+            
+            self.failUnlessEqual([self.tag1, self.tag2, self.tag3], entry1.tags_all)
+            self.failUnlessEqual([self.tag2],                       entry2.tags_all)
+            self.failUnlessEqual([self.tag2, self.tag3],            entry3.tags_all)
+            self.failUnlessEqual([],                                entry4.tags_all)
+            
+            # the sql doesn't depend on the number of entries
+            sql = db.connection.queries[-1]['sql']
+            db.reset_queries()
+            list(Entry.objects.batch_select(batch).filter(id=self.entry1.id))
+            self.failUnless('json_each(' in sql, sql)
+            self.failUnlessEqual(sql.split('json_each(')[0],
+                                 db.connection.queries[-1]['sql'].split('json_each(')[0])
+        
+        def test_batch_array_param_one_to_many(self):
+            section1 = Section.objects.create(name='s1')
+            section2 = Section.objects.create(name='s2')
+            
+            entry1 = Entry.objects.create(section=section1)
+            entry2 = Entry.objects.create(section=section1)
+            
+            batch = Batch('entry').array_param()
+            sections = Section.objects.batch_select(batch).order_by('id')
+            section1, section2 = list(sections)
+            
+            self.failUnlessEqual(set([entry1, entry2]), set(section1.entry_all))
+            self.failUnlessEqual([],                    section2.entry_all)
+        
+        def test_batch_array_param_non_id_primary_key(self):
+            uk = Country.objects.create(name='United Kingdom')
+            brighton = Location.objects.create(name='Brighton')
+            uk.locations.add(brighton)
+            
+            uk = Country.objects.batch_select(Batch('locations').array_param())[0]
+            self.failUnlessEqual([brighton], uk.locations_all)
+        
         def test_batch_annotate(self):
             section1 = Section.objects.create(name='s1')
             section2 = Section.objects.create(name='s2')
@@ -556,6 +959,597 @@ if getattr(settings, 'TESTING_BATCH_SELECT', False):
             self.failUnlessEqual(3, len(db.connection.queries))
 
 
+    class RecursiveBatchTestCase(TransactionTestCase):
+        
+        def setUp(self):
+            super(RecursiveBatchTestCase, self).setUp()
+            # root1
+            #   a
+            #     a1
+            #       a1x
+            #     a2
+            #   b
+            # root2
+            def _category(name, parent=None):
+                return Category.objects.create(name=name, parent=parent)
+            self.root1 = _category('root1')
+            self.a = _category('a', self.root1)
+            self.a1 = _category('a1', self.a)
+            self.a1x = _category('a1x', self.a1)
+            self.a2 = _category('a2', self.a)
+            self.b = _category('b', self.root1)
+            self.root2 = _category('root2')
+        
+        def _roots(self, batch):
+            return list(Category.objects.batch_select(batch)
+                                        .filter(parent=None).order_by('id'))
+        
+        @with_debug_queries
+        def test_recursive_empty(self):
+            db.reset_queries()
+            categories = Category.objects.filter(name='qwerty')\
+                                 .batch_select(Batch('children').recursive())
+            self.failUnlessEqual([], list(categories))
+            # only the query for the categories
+            self.failUnlessEqual(1, len(db.connection.queries))
+        
+        def test_recursive_explain(self):
+            qs = Category.objects.batch_select(Batch('children').recursive())\
+                                 .filter(parent=None).explain_batches()
+            list(qs)
+            report, = qs.batch_explain
+            self.failUnlessEqual('children_all', report['field'])
+            self.failUnlessEqual('recursive', report['strategy'])
+            self.failUnlessEqual('batch_select_category', report['table'])
+            self.failUnlessEqual('parent_id', report['column'])
+            self.failUnlessEqual(2, report['parents'])
+            self.failUnless('WITH RECURSIVE' in report['sql'])
+            self.failIf(not report['plan'])
+        
+        def test_recursive_batch_plans(self):
+            qs = Category.objects.batch_select(Batch('children').recursive(2))\
+                                 .filter(parent=None)
+            list(qs)
+            plan = qs.batch_plans['children_all']
+            self.failUnlessEqual('recursive', plan['strategy'])
+            self.failUnlessEqual(2, plan['parents'])
+            self.failUnlessEqual(2, plan['max_depth'])
+            self.failUnlessEqual('default', plan['using'])
+        
+        @with_debug_queries
+        def test_recursive(self):
+            db.reset_queries()
+            root1, root2 = self._roots(Batch('children').recursive().order_by('name'))
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual([self.a, self.b], root1.children_all)
+            self.failUnlessEqual([], root2.children_all)
+            
+            a, b = root1.children_all
+            self.failUnlessEqual([self.a1, self.a2], a.children_all)
+            self.failUnlessEqual([], b.children_all)
+            self.failUnlessEqual([self.a1x], a.children_all[0].children_all)
+            self.failUnlessEqual([], a.children_all[0].children_all[0].children_all)
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_recursive_max_depth(self):
+            root1, root2 = self._roots(Batch('children').recursive(max_depth=2).order_by('name'))
+            
+            a, b = root1.children_all
+            self.failUnlessEqual([self.a1, self.a2], a.children_all)
+            a1, a2 = a.children_all
+            self.failIf(hasattr(a1, 'children_all'))
+            self.failIf(hasattr(a2, 'children_all'))
+        
+        def test_recursive_filter(self):
+            batch = Batch('children').recursive().exclude(name='a1')
+            root1, root2 = self._roots(batch)
+            
+            a, b = sorted(root1.children_all, key=lambda c: c.name)
+            self.failUnlessEqual([self.a2], a.children_all)
+        
+        def test_recursive_not_self_referential(self):
+            Section.objects.create(name='s1')
+            try:
+                list(Section.objects.batch_select(Batch('entry').recursive()))
+                self.fail('recursive batch on non self-referential field')
+            except ValueError:
+                pass
+
+    class PathBatchTestCase(TransactionTestCase):
+        
+        def setUp(self):
+            super(PathBatchTestCase, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            
+            self.entry1 = Entry.objects.create(section=self.section1)
+            self.entry2 = Entry.objects.create(section=self.section1)
+            self.entry3 = Entry.objects.create(section=self.section2)
+            self.entry4 = Entry.objects.create()
+        
+        @with_debug_queries
+        def test_batch_select_path(self):
+            db.reset_queries()
+            entries = Entry.objects.select_related('section')\
+                                   .batch_select(section_entries='section__entry')\
+                                   .order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual(2, len(db.connection.queries))
+            
+            self.failUnlessEqual(set([self.entry1, self.entry2]),
+                                 set(entry1.section.section_entries))
+            self.failUnlessEqual(set([self.entry3]),
+                                 set(entry3.section.section_entries))
+            self.failUnless(entry4.section is None)
+            # both entries have the same section
+            self.failUnless(entry1.section.section_entries is
+                            entry2.section.section_entries)
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_batch_select_path_default_name(self):
+            entries = Entry.objects.select_related('section')\
+                                   .batch_select(Batch('section__entry').order_by('id'))\
+                                   .order_by('id')
+            entry1, entry2, entry3, entry4 = list(entries)
+            self.failUnlessEqual([self.entry1, self.entry2], entry1.section.entry_all)
+            self.failIf(hasattr(entry1, 'entry_all'))
+        
+        def test_batch_select_path_non_existant_field(self):
+            for fieldname in ('title__entry', 'tags__entry', 'section__qwerty'):
+                try:
+                    Entry.objects.batch_select(fieldname)
+                    self.fail('selected field that does not exist: %s' % fieldname)
+                except FieldDoesNotExist:
+                    pass
+
+    class PlannerTestCase(TransactionTestCase):
+        
+        def setUp(self):
+            super(PlannerTestCase, self).setUp()
+            planner._fanout_history.clear()
+            self.entry1, self.entry2, self.entry3 = _create_entries(3)
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry3.tags.add(self.tag2)
+        
+        def tearDown(self):
+            planner._fanout_history.clear()
+            super(PlannerTestCase, self).tearDown()
+        
+        def _check_tags(self, entries):
+            entry1, entry2, entry3 = entries
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([],                     entry2.tags_all)
+            self.failUnlessEqual([self.tag2],            entry3.tags_all)
+        
+        def test_plan_batch(self):
+            qs = Entry.objects.all()
+            
+            self.failUnlessEqual('in', planner.plan_batch(Entry, 'tags', 10)['strategy'])
+            self.failUnlessEqual('subquery',
+                                 planner.plan_batch(Entry, 'tags', 5000, parent_query=qs)['strategy'])
+            # can't use a sliced query as a subquery
+            self.failUnlessEqual('array',
+                                 planner.plan_batch(Entry, 'tags', 5000, parent_query=qs[:5000])['strategy'])
+            self.failUnlessEqual('chunked',
+                                 planner.plan_batch(Entry, 'tags', 10, strategy='chunked')['strategy'])
+            self.assertRaises(ValueError, planner.plan_batch, Entry, 'tags', 10, strategy='qwerty')
+            self.assertRaises(ValueError, planner.plan_batch, Entry, 'tags', 10, strategy='subquery')
+        
+        def test_plan_batch_fanout(self):
+            planner.record_fanout(Entry, 'tags', 10, 1000)
+            self.failUnlessEqual(100, planner.expected_fanout(Entry, 'tags'))
+            
+            plan = planner.plan_batch(Entry, 'tags', 500, parent_query=Entry.objects.all())
+            self.failUnlessEqual('chunked', plan['strategy'])
+            self.failUnlessEqual(100, plan['chunk_size'])
+            self.failUnlessEqual('in', planner.plan_batch(Entry, 'tags', 50)['strategy'])
+        
+        def test_plan_batch_temp_table(self):
+            old_vendor, old_supports_array_param = \
+                planner._vendor, planner.supports_array_param
+            planner.supports_array_param = lambda connection: False
+            try:
+                for vendor, strategy in (('sqlite', 'temp_table'),
+                                         ('postgresql', 'temp_table'),
+                                         ('mysql', 'chunked'),
+                                         ('oracle', 'chunked')):
+                    planner._vendor = lambda connection: vendor
+                    self.failUnlessEqual(strategy,
+                                         planner.plan_batch(Entry, 'tags', 20000)['strategy'])
+            finally:
+                planner._vendor, planner.supports_array_param = \
+                    old_vendor, old_supports_array_param
+        
+        def test_temp_table_sql(self):
+            class _Connection(object):
+                def __init__(self, vendor):
+                    self.vendor = vendor
+            self.failUnlessEqual('DROP TEMPORARY TABLE t',
+                                 backend.drop_temp_table_sql(_Connection('mysql'), 't'))
+            self.failUnlessEqual('DROP TABLE t',
+                                 backend.drop_temp_table_sql(_Connection('sqlite'), 't'))
+            self.failUnless(backend.supports_temp_table(_Connection('mysql')))
+            self.failIf(backend.supports_temp_table(_Connection('oracle')))
+        
+        def test_batch_plans(self):
+            qs = Entry.objects.batch_select('tags', section_tags=Batch('tags').strategy('subquery'))
+            list(qs)
+            self.failUnlessEqual('in', qs.batch_plans['tags_all']['strategy'])
+            self.failUnlessEqual(3, qs.batch_plans['tags_all']['parents'])
+            self.failUnlessEqual('subquery', qs.batch_plans['section_tags']['strategy'])
+            self.failUnlessEqual(1, planner.expected_fanout(Entry, 'tags'))
+        
+        def test_subquery_on_other_db(self):
+            # the parent query can't be used as a subquery on another
+            # database, and the plan shows the strategy that was used
+            qs = Entry.objects.all()
+            plan = planner.plan_batch(Entry, 'tags', 3, 'subquery', qs)
+            explain = []
+            batch_select(Entry, list(qs), 'tags_all', 'tags', explain=explain,
+                         plan=plan, parent_query=qs, using='other')
+            self.failUnlessEqual('chunked', plan['strategy'])
+            self.failUnlessEqual('chunked', explain[0]['strategy'])
+        
+        @with_debug_queries
+        def test_strategy_chunked(self):
+            old_max_in_list, planner.MAX_IN_LIST = planner.MAX_IN_LIST, 2
+            try:
+                db.reset_queries()
+                batch = Batch('tags').strategy('chunked').order_by('name')
+                self._check_tags(Entry.objects.batch_select(batch).order_by('id'))
+                self.failUnlessEqual(3, len(db.connection.queries))
+            finally:
+                planner.MAX_IN_LIST = old_max_in_list
+        
+        def test_strategy_chunked_merge(self):
+            old_max_in_list, planner.MAX_IN_LIST = planner.MAX_IN_LIST, 1
+            try:
+                batch = Batch('tags').strategy('chunked').merge().order_by('name')
+                self._check_tags(Entry.objects.batch_select(batch).order_by('id'))
+            finally:
+                planner.MAX_IN_LIST = old_max_in_list
+        
+        @with_debug_queries
+        def test_strategy_subquery(self):
+            db.reset_queries()
+            batch = Batch('tags').strategy('subquery').order_by('name')
+            self._check_tags(Entry.objects.batch_select(batch).order_by('id'))
+            self.failUnlessEqual(2, len(db.connection.queries))
+        
+        def test_strategy_temp_table(self):
+            batch = Batch('tags').strategy('temp_table').order_by('name')
+            self._check_tags(Entry.objects.batch_select(batch).order_by('id'))
+            
+            section = Section.objects.create(name='s1')
+            entry = Entry.objects.create(section=section)
+            section = Section.objects.batch_select(Batch('entry').strategy('temp_table'))[0]
+            self.failUnlessEqual([entry], section.entry_all)
+            
+            uk = Country.objects.create(name='United Kingdom')
+            brighton = Location.objects.create(name='Brighton')
+            uk.locations.add(brighton)
+            uk = Country.objects.batch_select(Batch('locations').strategy('temp_table'))[0]
+            self.failUnlessEqual([brighton], uk.locations_all)
+
+    class SerializeTestCase(TransactionTestCase):
+        
+        def setUp(self):
+            super(SerializeTestCase, self).setUp()
+            self.section1 = Section.objects.create(name='s1')
+            self.section2 = Section.objects.create(name='s2')
+            
+            self.entry1 = Entry.objects.create(title='e1', section=self.section1)
+            self.entry2 = Entry.objects.create(title='e2', section=self.section1)
+            
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag2)
+        
+        @with_debug_queries
+        def test_dumps_loads(self):
+            entries = Entry.objects.batch_select('tags').order_by('id')
+            data = serialize.dumps(entries)
+            
+            db.reset_queries()
+            entry1, entry2 = serialize.loads(data)
+            self.failUnlessEqual(0, len(db.connection.queries))
+            
+            self.failUnlessEqual(self.entry1, entry1)
+            self.failUnlessEqual('e1', entry1.title)
+            self.failUnlessEqual(self.section1.id, entry1.section_id)
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+            self.failUnlessEqual('tag2', entry2.tags_all[0].name)
+            self.failUnlessEqual('default', entry2.tags_all[0]._state.db)
+            # related instances are only stored (and created) once
+            self.failUnless(entry1.tags_all[1] is entry2.tags_all[0])
+        
+        def test_dumps_loads_nested(self):
+            batch = Batch('entry_set').order_by('id').batch_select('tags')
+            sections = Section.objects.batch_select(entries=batch).order_by('id')
+            section1, section2 = serialize.loads(serialize.dumps(sections))
+            
+            self.failUnlessEqual([self.section1, self.section2],
+                                 [section1, section2])
+            self.failUnlessEqual([self.entry1, self.entry2], section1.entries)
+            self.failUnlessEqual([], section2.entries)
+            self.failUnlessEqual([self.tag1, self.tag2],
+                                 section1.entries[0].tags_all)
+            self.failUnlessEqual([self.tag2], section1.entries[1].tags_all)
+        
+        def test_dumps_loads_recursive(self):
+            root = Category.objects.create(name='root')
+            child = Category.objects.create(name='child', parent=root)
+            Category.objects.create(name='grandchild', parent=child)
+            
+            roots = Category.objects.filter(parent=None)\
+                            .batch_select(Batch('children').recursive())
+            root, = serialize.loads(serialize.dumps(roots))
+            child, = root.children_all
+            self.failUnlessEqual('child', child.name)
+            self.failUnlessEqual(['grandchild'], [c.name for c in child.children_all])
+            self.failUnlessEqual([], child.children_all[0].children_all)
+            
+            # the levels below max_depth aren't batch selected
+            roots = Category.objects.filter(parent=None)\
+                            .batch_select(Batch('children').recursive(1))
+            root, = serialize.loads(serialize.dumps(roots))
+            self.failIf(hasattr(root.children_all[0], 'children_all'))
+        
+        @with_debug_queries
+        def test_dumps_loads_deferred(self):
+            entries = Entry.objects.defer('title')\
+                                   .batch_select(Batch('tags').only('id'))\
+                                   .order_by('id')
+            list(entries)
+            db.reset_queries()
+            data = serialize.dumps(entries)
+            # the deferred fields aren't loaded one at a time
+            self.failUnlessEqual(0, len(db.connection.queries))
+            
+            entry1, entry2 = serialize.loads(data)
+            self.failIf('title' in entry1.__dict__)
+            self.failUnlessEqual(self.section1.id, entry1.section_id)
+            self.failIf('name' in entry1.tags_all[0].__dict__)
+            self.failUnlessEqual([self.tag1.pk, self.tag2.pk],
+                                 [tag.pk for tag in entry1.tags_all])
+            # and are loaded when used, as before
+            self.failUnlessEqual('e1', entry1.title)
+            self.failUnlessEqual('tag1', entry1.tags_all[0].name)
+        
+        def test_dumps_shared_children_once(self):
+            # tag2 is on both entries, but its entries are only stored once
+            batch = Batch('tags').order_by('id').batch_select(Batch('entry').order_by('id'))
+            entries = Entry.objects.batch_select(batch).order_by('id')
+            version, table_index, rows, tables = cPickle.loads(serialize.dumps(entries))
+            
+            tag_table = [table for table in tables if table[1] == 'Tag'][0]
+            links = dict((link[0], link[2:]) for link in tag_table[6])
+            parent_rows, child_rows = links['entry_all']
+            self.failUnlessEqual([0, 1], sorted(parent_rows))
+            
+            entry1, entry2 = serialize.loads(serialize.dumps(entries))
+            tag2 = entry2.tags_all[0]
+            self.failUnless(entry1.tags_all[1] is tag2)
+            self.failUnlessEqual([self.entry1, self.entry2], tag2.entry_all)
+            self.failUnlessEqual([self.entry1], entry1.tags_all[0].entry_all)
+
+    class ExportTestCase(TransactionTestCase):
+        
+        def setUp(self):
+            super(ExportTestCase, self).setUp()
+            self.entry1 = Entry.objects.create(title='e1')
+            self.entry2 = Entry.objects.create(title='e2')
+            self.entry3 = Entry.objects.create(title='e3')
+            self.tag1, self.tag2 = _create_tags('tag1', 'tag2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry3.tags.add(self.tag2)
+        
+        def test_partitions(self):
+            e1, e2, e3 = self.entry1.pk, self.entry2.pk, self.entry3.pk
+            self.failUnlessEqual([(None, e2), (e2, None)],
+                                 list(_partitions(Entry.objects.all(), 2)))
+            self.failUnlessEqual([(None, e1), (e1, e2), (e2, e3), (e3, None)],
+                                 list(_partitions(Entry.objects.all(), 1)))
+        
+        def test_export_jsonl(self):
+            out = StringIO()
+            entries = Entry.objects.batch_select(Batch('tags').order_by('id'))
+            export(entries, out, partition_size=2)
+            
+            lines = [simplejson.loads(line) for line in out.getvalue().splitlines()]
+            self.failUnlessEqual(['e1', 'e2', 'e3'], [line['title'] for line in lines])
+            self.failUnlessEqual([self.tag1.pk, self.tag2.pk],
+                                 [tag['id'] for tag in lines[0]['tags_all']])
+            self.failUnlessEqual('tag1', lines[0]['tags_all'][0]['name'])
+            self.failUnlessEqual([], lines[1]['tags_all'])
+            self.failUnlessEqual([self.tag2.pk],
+                                 [tag['id'] for tag in lines[2]['tags_all']])
+        
+        def test_export_csv(self):
+            out = StringIO()
+            entries = Entry.objects.batch_select(Batch('tags').order_by('id'))
+            export(entries, out, format='csv', partition_size=1)
+            
+            rows = list(csv.reader(StringIO(out.getvalue())))
+            self.failUnlessEqual(['id', 'title', 'section_id', 'location_id', 'tags_all'],
+                                 rows[0])
+            self.failUnlessEqual(['e1', 'e2', 'e3'], [row[1] for row in rows[1:]])
+            self.failUnlessEqual('', rows[1][2])
+            self.failUnlessEqual([self.tag1.pk, self.tag2.pk], simplejson.loads(rows[1][4]))
+            self.failUnlessEqual([], simplejson.loads(rows[2][4]))
+        
+        def test_export_unknown_format(self):
+            self.assertRaises(ValueError, export, Entry.objects.all(), StringIO(), 'xml')
+        
+        def test_export_recursive(self):
+            root = Category.objects.create(name='root')
+            child = Category.objects.create(name='child', parent=root)
+            Category.objects.create(name='grandchild', parent=child)
+            
+            out = StringIO()
+            export(Category.objects.filter(parent=None)
+                           .batch_select(Batch('children').recursive()), out)
+            line, = [simplejson.loads(line) for line in out.getvalue().splitlines()]
+            child, = line['children_all']
+            self.failUnlessEqual('child', child['name'])
+            grandchild, = child['children_all']
+            self.failUnlessEqual('grandchild', grandchild['name'])
+            self.failUnlessEqual([], grandchild['children_all'])
+        
+        def test_export_path_batch(self):
+            # the batch selected fields would be on the sections
+            entries = Entry.objects.select_related('section').batch_select('section__entry')
+            self.assertRaises(ValueError, export, entries, StringIO())
+            tags = Tag.objects.batch_select(Batch('entry').batch_select('section__entry'))
+            self.assertRaises(ValueError, export, tags, StringIO())
+            self.assertRaises(CommandError, BatchExportCommand().handle,
+                              'batch_select.Entry', batches=['section__entry'],
+                              format='jsonl', processes=1, partition_size=1000,
+                              output=None)
+        
+        def test_export_processes(self):
+            # a database in a file, so the other processes can see it
+            fd, filename = tempfile.mkstemp()
+            os.close(fd)
+            db.connections.databases['export'] = {
+                'NAME': filename,
+                'ENGINE': 'django.db.backends.sqlite3',
+            }
+            try:
+                call_command('syncdb', database='export', verbosity=0,
+                             interactive=False)
+                tags = [Tag.objects.using('export').create(name='tag%d' % i)
+                        for i in xrange(3)]
+                for i in xrange(10):
+                    entry = Entry.objects.using('export').create(title='e%d' % i)
+                    entry.tags.add(*tags[:i % 4])
+                
+                # (with a partition_size of 1 there are more partitions
+                # than are run at once)
+                for format, partition_size in itertools.product(FORMATS, (1, 3)):
+                    entries = Entry.objects.using('export')\
+                                           .batch_select(Batch('tags').order_by('id'))
+                    single, multiple = StringIO(), StringIO()
+                    export(entries, single, format=format,
+                           partition_size=partition_size)
+                    export(entries, multiple, format=format, processes=2,
+                           partition_size=partition_size)
+                    self.failUnlessEqual(single.getvalue(), multiple.getvalue())
+                    self.failUnless('e9' in multiple.getvalue())
+            finally:
+                db.connections['export'].close()
+                del db.connections._connections['export']
+                del db.connections.databases['export']
+                os.remove(filename)
+        
+        def test_batch_export_command(self):
+            fd, filename = tempfile.mkstemp()
+            os.close(fd)
+            try:
+                call_command('batch_export', 'batch_select.Entry', batches=['tags'],
+                             output=filename)
+                lines = [simplejson.loads(line) for line in open(filename)]
+            finally:
+                os.remove(filename)
+            self.failUnlessEqual(['e1', 'e2', 'e3'], [line['title'] for line in lines])
+            self.failUnlessEqual(2, len(lines[0]['tags_all']))
+
+    class MultiDbTestCase(TransactionTestCase):
+        multi_db = True
+        
+        def setUp(self):
+            super(MultiDbTestCase, self).setUp()
+            self.tag1 = Tag.objects.using('other').create(name='tag1')
+            self.tag2 = Tag.objects.using('other').create(name='tag2')
+            self.entry1 = Entry.objects.using('other').create(title='e1')
+            self.entry2 = Entry.objects.using('other').create(title='e2')
+            self.entry1.tags.add(self.tag1, self.tag2)
+            self.entry2.tags.add(self.tag2)
+            # same pk as entry1, but on the default database
+            self.default_entry = Entry.objects.create(title='d1')
+        
+        def test_batch_select_follows_parent_db(self):
+            entries = Entry.objects.using('other').batch_select('tags').order_by('id')
+            entry1, entry2 = entries
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            self.failUnlessEqual([self.tag2], entry2.tags_all)
+            self.failUnlessEqual('other', entry1.tags_all[0]._state.db)
+            
+            entries = Entry.objects.batch_select('tags')
+            self.failUnlessEqual([[]], [e.tags_all for e in entries])
+        
+        def test_batch_select_mixed_dbs(self):
+            instances = [self.default_entry] + \
+                        list(Entry.objects.using('other').order_by('id'))
+            batch_select(Entry, instances, 'tags_all', 'tags')
+            self.failUnlessEqual([[], [self.tag1, self.tag2], [self.tag2]],
+                                 [e.tags_all for e in instances])
+        
+        def test_batch_using(self):
+            entries = Entry.objects.batch_select(Batch('tags').using('other'))
+            entry, = entries
+            self.failUnlessEqual([self.tag1, self.tag2], entry.tags_all)
+            self.failUnlessEqual('other', entries.batch_plans['tags_all']['using'])
+        
+        def test_reuse_batches_other_db(self):
+            # entry1 (on other) and default_entry have the same pk
+            default_tag = Tag.objects.create(name='default-tag')
+            self.default_entry.tags.add(default_tag)
+            qs = Entry.objects.batch_select('tags').reuse_batches()
+            self.failUnlessEqual([[default_tag]], [e.tags_all for e in qs])
+            
+            for derived in (qs.using('other'),
+                            qs.filter(pk=self.entry1.pk).using('other')):
+                entry = list(derived.order_by('id'))[0]
+                self.failUnlessEqual('other', entry._state.db)
+                self.failUnlessEqual([self.tag1, self.tag2], entry.tags_all)
+                self.failUnlessEqual('other', entry.tags_all[0]._state.db)
+        
+        def test_batch_select_recursive(self):
+            root = Category.objects.using('other').create(name='root')
+            Category.objects.using('other').create(name='child', parent=root)
+            Category.objects.create(name='default')
+            
+            categories = Category.objects.using('other')\
+                                 .filter(parent__isnull=True)\
+                                 .batch_select(Batch('children').recursive())
+            root, = categories
+            self.failUnlessEqual(['child'], [c.name for c in root.children_all])
+            self.failUnlessEqual('other', root.children_all[0]._state.db)
+        
+        def test_batch_update_mixed_dbs(self):
+            instances = [self.default_entry] + \
+                        list(Entry.objects.using('other').order_by('id'))
+            batch_select(Entry, instances, 'tags_all', 'tags')
+            default_entry, entry1, entry2 = instances
+            # entry1 and default_entry have the same pk
+            self.assertRaises(ValueError, batch_update, Entry, instances,
+                              'tags_all', 'tags', { entry1.pk: [self.tag1] })
+            self.failUnlessEqual([self.tag1, self.tag2], entry1.tags_all)
+            
+            batch_update(Entry, instances, 'tags_all', 'tags',
+                         { ('other', entry1.pk): [self.tag1] })
+            self.failUnlessEqual([self.tag1], entry1.tags_all)
+            self.failUnlessEqual([], default_entry.tags_all)
+            self.failUnlessEqual([self.tag1],
+                                 list(Entry.objects.using('other')
+                                                   .get(pk=entry1.pk).tags.all()))
+            self.failUnlessEqual(0, Entry.tags.through.objects.count())
+        
+        def test_batch_update_writes_to_instance_db(self):
+            entries = list(Entry.objects.using('other').batch_select('tags')
+                                                       .order_by('id'))
+            batch_update(Entry, entries, 'tags_all', 'tags',
+                         { self.entry1.pk: [self.tag1],
+                           self.entry2.pk: [self.tag1] })
+            self.failUnlessEqual([[self.tag1], [self.tag1]],
+                                 [list(e.tags.all()) for e in
+                                  Entry.objects.using('other').order_by('id')])
+            self.failUnlessEqual(0, Entry.tags.through.objects.count())
+    
     class ReplayTestCase(unittest.TestCase):
         
         def setUp(self):
@@ -11,6 +11,12 @@ DATABASES = {
         'NAME': DATABASE_NAME,
         'ENGINE': 'django.db.backends.sqlite3',
     },
+    # for the multiple database tests (a different NAME so that it is not
+    # treated as the same database, the test database is still in memory)
+    'other': {
+        'NAME': 'other',
+        'ENGINE': 'django.db.backends.sqlite3',
+    },
 }
 
 INSTALLED_APPS = ( 'batch_select', )